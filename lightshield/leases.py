@@ -0,0 +1,96 @@
+"""Task reservations held by a service instance."""
+import asyncio
+
+from lightshield import settings
+
+
+class Leases:
+    """Keep the reservations of tasks held by this instance alive.
+
+    Tasks are reserved by setting the reservation column to an expiry timestamp and
+    the owner column to settings.OWNER_ID. Only tasks registered through hold are
+    renewed, once a task is released (flushed or given up) its lease runs out and
+    the task becomes available to all instances again.
+    Expired leases of any owner are cleared on each run.
+    """
+
+    def __init__(self, table, column, keys, logging, owner=None):
+        """Initialize the lease tracking.
+
+        table: Table holding the tasks, e.g. europe.match.
+        column: Reservation timestamp column.
+        keys: List of (column, postgres type) identifying a task.
+        owner: Owner column, defaults to [column]_by.
+        """
+        self.table = table
+        self.column = column
+        self.owner = owner or "%s_by" % column
+        self.keys = keys
+        self.logging = logging
+        self.held = set()
+
+    def hold(self, keys):
+        """Register reserved tasks as tuples of their key values."""
+        self.held.update(keys)
+
+    def release(self, keys):
+        """Stop renewing tasks as tuples of their key values."""
+        self.held.difference_update(keys)
+
+    async def renew(self, connection):
+        """Extend the leases of all held tasks."""
+        if not self.held:
+            return
+        held = list(self.held)
+        await connection.execute(
+            """UPDATE %s AS target
+                SET %s = current_timestamp + $2 * INTERVAL '1 minute'
+                FROM unnest(%s) AS held (%s)
+                WHERE %s
+                AND target.%s = $1
+            """
+            % (
+                self.table,
+                self.column,
+                ", ".join(
+                    "$%s::%s[]" % (index + 3, key_type)
+                    for index, (_, key_type) in enumerate(self.keys)
+                ),
+                ", ".join(key for key, _ in self.keys),
+                " AND ".join(
+                    "target.%s = held.%s" % (key, key) for key, _ in self.keys
+                ),
+                self.owner,
+            ),
+            settings.OWNER_ID,
+            settings.RESERVE_MINUTES,
+            *[list(values) for values in zip(*held)],
+        )
+
+    async def sweep(self, connection):
+        """Clear the expired leases of all instances."""
+        await connection.execute(
+            """UPDATE %s
+                SET %s = NULL,
+                    %s = NULL
+                WHERE %s IS NOT NULL
+                AND %s < current_timestamp
+            """
+            % (self.table, self.column, self.owner, self.owner, self.column)
+        )
+
+    async def keep(self, postgres, running):
+        """Renew held leases and clear expired ones at half the lease duration.
+
+        running: Callable returning whether the service is currently running.
+        """
+        while True:
+            await asyncio.sleep(settings.RESERVE_MINUTES * 30)
+            if not running():
+                continue
+            try:
+                async with postgres.acquire() as connection:
+                    await self.renew(connection)
+                    await self.sweep(connection)
+            except Exception as err:
+                self.logging.error(err)
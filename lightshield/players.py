@@ -0,0 +1,24 @@
+"""Players found by the services."""
+
+# Stream consumed by the glue service, entries are trimmed beyond this length
+stream = "summoner_puuids"
+max_length = 1000000
+
+
+async def publish(redis, players, logging):
+    """Pass the puuids of players to the glue service through a redis stream.
+
+    players: Iterable of (puuid, platform).
+    """
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            for puuid, platform in players:
+                pipe.xadd(
+                    stream,
+                    {"puuid": puuid, "platform": platform},
+                    maxlen=max_length,
+                    approximate=True,
+                )
+            await pipe.execute()
+    except Exception:
+        logging.exception("Failed to publish puuids.")
@@ -1 +1,2 @@
 from .main import Proxy
+from .payload import Payload
@@ -1,6 +1,8 @@
 import asyncio
 import logging
+from collections import deque
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 
 from lightshield.exceptions import (
     LimitBlocked,
@@ -8,6 +10,7 @@ from lightshield.exceptions import (
     NotFoundException,
     Non200Exception,
 )
+from .payload import Payload, loads
 
 
 class Endpoint:
@@ -15,12 +18,14 @@ class Endpoint:
 
     blocked_until = None
 
-    def __init__(self, server, zone, redis, namespace):
+    def __init__(self, server, zone, redis, namespace, sync, sessions):
         self.server = server
         self.zone = zone
         self.namespace = namespace
 
         self.redis = redis
+        self.sync = sync
+        self.sessions = sessions
         self.logging = logging.getLogger("Proxy")
 
         self.key_server = "%s:%s" % (self.namespace, self.server)
@@ -28,29 +33,36 @@ class Endpoint:
         self.logging.info("Server: %s, Zone: %s", self.key_server, self.key_zone)
 
         self.permit = None
-        self.update = None
+        self.server_limits = {}
+        self.zone_limits = {}
+        self.buckets = {}  # Local mirror of bucket state: [max, count, reset]
+        self.waiters = deque()  # Futures waiting for a slot in order of arrival
+        self.dispatcher = None
 
     async def init(self):
         self.permit = await self.redis.get("lightshield_permit_handler")
-        self.limits_init = await self.redis.get("lightshield_limits_init")
-        self.limits_drop = await self.redis.get("lightshield_limits_drop")
-        self.limits_update = await self.redis.get("lightshield_limits_update")
-        self.update = await self.redis.get("lightshield_update_single")
 
         await self.redis.hsetnx(self.key_server, "placeholder", "H")
         await self.redis.hsetnx(self.key_zone, "placeholder", "H")
         self.logging.info("Initialized")
 
     async def response(
-        self, local_limits, key, header_limits, header_counts, request_timestamp
+        self,
+        local_limits,
+        key,
+        header_limits,
+        header_counts,
+        request_timestamp,
+        response_stamp,
     ):
+        """Buffer changes to limits and counts found in the response headers."""
         # Changes to limits
         to_init = []
         to_drop = []
         to_update = []
 
         # Changes to limit count
-        updates = []
+        counts = []
 
         limits = {}
         for limit in local_limits:
@@ -70,8 +82,8 @@ class Endpoint:
             limits[span]["found"] = True
 
         for limit_string in header_limits.split(","):
-            max, span = [int(el) for el in limit_string.split(":")]
-            limits[span]["max"] = max
+            limit_max, span = [int(el) for el in limit_string.split(":")]
+            limits[span]["max"] = limit_max
 
         for span, val in limits.items():
             if not val["preexisting"]:
@@ -82,55 +94,177 @@ class Endpoint:
                 to_update += [val["max"], span]
 
             if val["found"]:
-                updates.append(
-                    [
-                        self.update,
-                        2,
-                        "%s:%s" % (key, span),
-                        "%s:%s:meta" % (key, span),
-                        request_timestamp,
-                        val["count"],
-                    ]
-                )
-        return to_init, to_update, to_drop, updates
-
-    async def request(self, url, session, no_block=True):
-        """Initiate a request through the proxy."""
+                counts.append([span, val["count"]])
+                if bucket := self.buckets.get("%s:%s" % (key, span)):
+                    bucket[1] = max(bucket[1], val["count"])
+        await self.sync.add(
+            key, to_init, to_update, to_drop, counts, request_timestamp, response_stamp
+        )
 
+    async def wait_blocked(self, no_block=True):
+        """Wait for or raise on a local block set while limits are unknown."""
         if self.blocked_until:
             while datetime.now() < self.blocked_until:
                 if no_block:
-                    raise LimitBlocked(
-                        retry_after=(
-                            self.blocked_until - datetime.now()
-                        ).total_seconds()
-                    )
+                    delay = self.blocked_until - datetime.now()
+                    raise LimitBlocked(retry_after=delay.total_seconds() * 1000)
                 await asyncio.sleep(0.01)
             self.blocked_until = None
 
-        server_limits = await self.redis.hgetall(self.key_server)
-        del server_limits["placeholder"]
-        zone_limits = await self.redis.hgetall(self.key_zone)
-        del zone_limits["placeholder"]
-        if not server_limits or not zone_limits:
+    def mirror(self, key, state):
+        """Mirror the bucket state returned by the permit handler locally.
+
+        Returns the limits known for the key.
+        """
+        now = datetime.now()
+        limits = {}
+        for index in range(0, len(state), 4):
+            span, max_count, count, pttl = state[index : index + 4]
+            limits[span] = max_count
+            bucket = "%s:%s" % (key, span)
+            if int(pttl) > 0:
+                self.buckets[bucket] = [
+                    int(max_count),
+                    int(count),
+                    now + timedelta(milliseconds=int(pttl)),
+                ]
+            else:
+                self.buckets.pop(bucket, None)
+        return limits
+
+    def local_wait(self):
+        """Return the wait in ms until all buckets known to be full have reset."""
+        now = datetime.now()
+        wait = 0
+        for max_count, count, reset in self.buckets.values():
+            if count >= max_count and reset > now:
+                wait = max(wait, int((reset - now).total_seconds() * 1000))
+        return wait
+
+    def remaining(self, key=None):
+        """Return the requests left in the fullest known bucket or None if none are known.
+
+        If a key is given only the buckets of that key are considered.
+        """
+        now = datetime.now()
+        remaining = None
+        for bucket, (max_count, count, reset) in self.buckets.items():
+            if key and bucket.rsplit(":", 1)[0] != key:
+                continue
+            available = max_count if reset <= now else max(0, max_count - count)
+            if remaining is None or available < remaining:
+                remaining = available
+        return remaining
+
+    async def reserve(self, n=1, request_timestamp=None):
+        """Reserve up to n request slots with a single permit call.
+
+        Returns the amount of granted slots and the wait in ms for the remaining ones.
+        Buckets known to be full locally are rejected without contacting redis.
+        """
+        if wait := self.local_wait():
+            return 0, wait
+        if not request_timestamp:
+            request_timestamp = int(datetime.now().timestamp() * 1000)
+        wait, granted, server_state, zone_state = await self.redis.evalsha(
+            self.permit, 2, self.key_server, self.key_zone, request_timestamp, n
+        )
+        self.server_limits = self.mirror(self.key_server, server_state)
+        self.zone_limits = self.mirror(self.key_zone, zone_state)
+        if not self.server_limits or not self.zone_limits:
             self.blocked_until = datetime.now() + timedelta(seconds=5)
+        return int(granted), int(wait)
+
+    async def acquire(self):
+        """Wait in line for a request slot.
+
+        Waiters are served in order and woken once a slot was reserved for them.
+        Returns the timestamp used for the reservation.
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        if not self.dispatcher or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        return await waiter
+
+    async def dispatch(self):
+        """Reserve slots for all queued waiters and wake as many as fit."""
+        while self.waiters:
+            self.waiters = deque(waiter for waiter in self.waiters if not waiter.done())
+            if not self.waiters:
+                return
+            request_timestamp = int(datetime.now().timestamp() * 1000)
+            try:
+                await self.wait_blocked(no_block=False)
+                granted, wait = await self.reserve(len(self.waiters), request_timestamp)
+            except Exception as err:
+                while self.waiters:
+                    waiter = self.waiters.popleft()
+                    if not waiter.done():
+                        waiter.set_exception(err)
+                return
+            for _ in range(min(granted, len(self.waiters))):
+                waiter = self.waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(request_timestamp)
+            if self.waiters and wait:
+                await asyncio.sleep(wait / 1000)
+
+    async def request(self, url, session=None, no_block=True, api_key=None, raw=False):
+        """Initiate a request through the proxy.
+
+        With no_block set a LimitBlocked is raised if no slot is available,
+        otherwise the request waits in line until one is.
+        If no session is provided the shared session for the host and api_key is used.
+        With raw set a Payload holding the undecoded body is returned.
+        """
+        if not no_block:
+            request_timestamp = await self.acquire()
+            return await self.fetch(url, session, request_timestamp, api_key, raw)
+        await self.wait_blocked(no_block)
 
         request_timestamp = int(datetime.now().timestamp() * 1000)
-        keys = []
-        if server_limits:
-            keys.append(self.key_server)
-        if zone_limits:
-            keys.append(self.key_zone)
-        response = 0
-        if keys:
-            response = await self.redis.evalsha(
-                self.permit, len(keys), *keys, request_timestamp
+        granted, wait = await self.reserve(1, request_timestamp)
+        if not granted:
+            raise LimitBlocked(retry_after=wait)
+        return await self.fetch(url, session, request_timestamp, api_key, raw)
+
+    async def request_many(
+        self, urls, session=None, no_block=True, api_key=None, raw=False
+    ):
+        """Initiate multiple requests through the proxy sharing a single permit call.
+
+        Returns a list matching the order of the provided urls that contains either
+        the response or the exception raised for each url. Requests that did not
+        fit into the current limits are returned as LimitBlocked.
+        Without no_block all requests wait in line until a slot is available.
+        """
+        if not no_block:
+            return await asyncio.gather(
+                *[self.request(url, session, False, api_key, raw) for url in urls],
+                return_exceptions=True,
             )
+        await self.wait_blocked(no_block)
+
+        request_timestamp = int(datetime.now().timestamp() * 1000)
+        granted, wait = await self.reserve(len(urls), request_timestamp)
+        results = await asyncio.gather(
+            *[
+                self.fetch(url, session, request_timestamp, api_key, raw)
+                for url in urls[:granted]
+            ],
+            return_exceptions=True,
+        )
+        return results + [LimitBlocked(retry_after=wait) for _ in urls[granted:]]
 
-        if int(response) > 0:
-            raise LimitBlocked(retry_after=response)
+    async def fetch(self, url, session, request_timestamp, api_key=None, raw=False):
+        """Execute a request for an already reserved slot."""
+        if not session:
+            session = self.sessions.get(urlsplit(url).netloc, api_key)
+        server_limits = self.server_limits
+        zone_limits = self.zone_limits
         async with session.get(url) as response:
-            response_json = await response.json()
+            body = await response.read()
             status = response.status
             headers = response.headers
 
@@ -138,50 +272,30 @@ class Endpoint:
 
         if "X-App-Rate-Limit" in headers:
             self.logging.debug("Limits for App: %s", server_limits)
-            init, update, drop, update_c = await self.response(
+            await self.response(
                 local_limits=server_limits,
                 key=self.key_server,
                 header_limits=headers.get("X-App-Rate-Limit"),
                 header_counts=headers.get("X-App-Rate-Limit-Count"),
                 request_timestamp=request_timestamp,
+                response_stamp=response_stamp,
             )
-            async with self.redis.pipeline(transaction=True) as pipe:
-                if init:
-                    pipe.evalsha(
-                        self.limits_init, 1, self.key_server, response_stamp, *init
-                    )
-                if update:
-                    pipe.evalsha(self.limits_update, 1, self.key_server, *update)
-                if drop:
-                    pipe.evalsha(self.limits_drop, 1, self.key_server, *drop)
-                for entry in update_c:
-                    pipe.evalsha(*entry)
-                await pipe.execute()
 
         if "X-Method-Rate-Limit" in headers:
             self.logging.debug("Limits for Method: %s", zone_limits)
-            init, update, drop, update_c = await self.response(
+            await self.response(
                 local_limits=zone_limits,
                 key=self.key_zone,
                 header_limits=headers.get("X-Method-Rate-Limit"),
                 header_counts=headers.get("X-Method-Rate-Limit-Count"),
                 request_timestamp=request_timestamp,
+                response_stamp=response_stamp,
             )
-            async with self.redis.pipeline(transaction=True) as pipe:
-                if init:
-                    pipe.evalsha(
-                        self.limits_init, 1, self.key_zone, response_stamp, *init
-                    )
-                if update:
-                    pipe.evalsha(self.limits_update, 1, self.key_zone, *update)
-                if drop:
-                    pipe.evalsha(self.limits_drop, 1, self.key_zone, *drop)
-                for entry in update_c:
-                    pipe.evalsha(*entry)
-                await pipe.execute()
 
         if status == 200:
-            return response_json
+            if raw:
+                return Payload(body)
+            return loads(body)
         if status == 404:
             raise NotFoundException()
         if status == 429:
@@ -4,6 +4,8 @@ import re
 import aioredis
 
 from .endpoint import Endpoint
+from .sessions import SessionPool
+from .sync import LimitSync
 
 pattern = "https://([\w\d]*)\.api\.riotgames\.com(/[^/]*/[^/]*/[v\d]*/[^/]+).*"
 compiled = re.compile(pattern)
@@ -12,11 +14,15 @@ compiled = re.compile(pattern)
 class Proxy:
     """Central proxy element to be imported."""
 
-    def __init__(self, server_first=True):
+    def __init__(self, server_first=True, sync_interval=0.005, sync_batch=100):
 
         self.redis = None
+        self.sync = None
+        self.sessions = SessionPool()
         self.endpoints = {}
         self.server_first = server_first
+        self.sync_interval = sync_interval
+        self.sync_batch = sync_batch
         self.logging = logging.getLogger("Proxy")
 
     async def init(self, host="localhost", port=6379, namespace="ratelimiter"):
@@ -24,6 +30,8 @@ class Proxy:
             "redis://%s:%s" % (host, port), encoding="utf-8", decode_responses=True
         )
         self.namespace = namespace
+        self.sync = LimitSync(self.redis, self.sync_interval, self.sync_batch)
+        await self.sync.init()
 
     async def get_endpoint(self, server, zone):
         """Return the endpoint used by a provided url."""
@@ -31,7 +39,13 @@ class Proxy:
         try:
             return self.endpoints[limit_key]
         except KeyError:
-            endpoint = Endpoint(server, zone, self.redis, self.namespace)
+            endpoint = Endpoint(
+                server, zone, self.redis, self.namespace, self.sync, self.sessions
+            )
             await endpoint.init()
             self.endpoints[limit_key] = endpoint
             return endpoint
+
+    async def close(self):
+        """Close all shared client sessions."""
+        await self.sessions.close()
@@ -0,0 +1,37 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def loads(raw):
+    """Decode a JSON body, using orjson if it is installed."""
+    if orjson:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+class Payload:
+    """Raw response body with a lazily decoded view.
+
+    The body is only decoded on first access of the data, allowing callers to
+    store the original bytes without a decode and encode round trip.
+    """
+
+    __slots__ = ("raw", "_data")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._data = None
+
+    @property
+    def data(self):
+        """Decoded body."""
+        if self._data is None:
+            self._data = loads(self.raw)
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
@@ -0,0 +1,38 @@
+import aiohttp
+
+
+class SessionPool:
+    """Long lived client sessions shared by all endpoints.
+
+    Sessions are kept per host and API key so connections (and their TLS handshakes)
+    are reused across requests instead of being opened for every task.
+    """
+
+    def __init__(self, limit_per_host=100, dns_ttl=300, keepalive=60):
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive = keepalive
+        self.sessions = {}
+
+    def get(self, host, api_key=None):
+        """Return the session for a host and API key, creating it if required."""
+        session = self.sessions.get((host, api_key))
+        if not session or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive,
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"X-Riot-Token": api_key} if api_key else None,
+            )
+            self.sessions[(host, api_key)] = session
+        return session
+
+    async def close(self):
+        """Close all open sessions."""
+        sessions, self.sessions = self.sessions, {}
+        for session in sessions.values():
+            await session.close()
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+
+
+class LimitSync:
+    """Buffer limit changes derived from response headers and flush them in batches.
+
+    Updates from all endpoints are collected and written in a single pipeline either
+    after a short interval or once enough responses have been buffered.
+    Count updates for the same bucket are coalesced keeping only the highest count.
+    """
+
+    flusher = None
+
+    def __init__(self, redis, interval=0.005, batch_size=100):
+        self.redis = redis
+        self.interval = interval
+        self.batch_size = batch_size
+        self.logging = logging.getLogger("Proxy")
+
+        self.limits = {}  # key: {span: [action, max]}
+        self.stamps = {}  # key: response timestamp used to initiate new buckets
+        self.counts = {}  # (key, span): [request timestamp, count, responses]
+        self.responses = 0
+
+    async def init(self):
+        self.limits_init = await self.redis.get("lightshield_limits_init")
+        self.limits_drop = await self.redis.get("lightshield_limits_drop")
+        self.limits_update = await self.redis.get("lightshield_limits_update")
+        self.update = await self.redis.get("lightshield_update_single")
+
+    async def add(self, key, init, update, drop, counts, request_timestamp, stamp):
+        """Buffer the changes found in a single response."""
+        if init or update or drop:
+            changes = self.limits.setdefault(key, {})
+            for index in range(0, len(init), 2):
+                changes[init[index + 1]] = ["init", init[index]]
+            for index in range(0, len(update), 2):
+                changes[update[index + 1]] = ["update", update[index]]
+            for span in drop:
+                changes[span] = ["drop", None]
+            self.stamps[key] = stamp
+
+        for span, count in counts:
+            bucket = self.counts.get((key, span))
+            if not bucket:
+                self.counts[(key, span)] = [request_timestamp, count, 1]
+                continue
+            if count > bucket[1]:
+                bucket[0] = request_timestamp
+                bucket[1] = count
+            bucket[2] += 1
+
+        self.responses += 1
+        if self.responses >= self.batch_size:
+            await self.flush()
+        elif not self.flusher:
+            self.flusher = asyncio.create_task(self.delayed_flush())
+
+    async def delayed_flush(self):
+        """Flush after the sync interval has passed."""
+        await asyncio.sleep(self.interval)
+        self.flusher = None
+        await self.flush()
+
+    async def flush(self):
+        """Write all buffered changes in a single transaction."""
+        limits, self.limits = self.limits, {}
+        stamps, self.stamps = self.stamps, {}
+        counts, self.counts = self.counts, {}
+        self.responses = 0
+        if not limits and not counts:
+            return
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                for key, changes in limits.items():
+                    init = []
+                    update = []
+                    drop = []
+                    for span, (action, max) in changes.items():
+                        if action == "init":
+                            init += [max, span]
+                        elif action == "update":
+                            update += [max, span]
+                        else:
+                            drop.append(span)
+                    if init:
+                        pipe.evalsha(self.limits_init, 1, key, stamps[key], *init)
+                    if update:
+                        pipe.evalsha(self.limits_update, 1, key, *update)
+                    if drop:
+                        pipe.evalsha(self.limits_drop, 1, key, *drop)
+                for (key, span), bucket in counts.items():
+                    pipe.evalsha(
+                        self.update,
+                        2,
+                        "%s:%s" % (key, span),
+                        "%s:%s:meta" % (key, span),
+                        *bucket,
+                    )
+                await pipe.execute()
+        except Exception:
+            self.logging.exception("Failed to sync limits.")
@@ -9,6 +9,8 @@ Variables are overwritten as follows:
 import json
 import logging
 import os
+import socket
+import uuid
 
 logger = logging.getLogger("Settings")
 
@@ -93,26 +95,40 @@ PERSISTENT_USER = CONFIG.get("PERSISTENT_USER", "postgres")
 PERSISTENT_PASSWORD = CONFIG.get("PERSISTENT_PASSWORD", None)
 #  Manager max queue sizes
 QUEUE_LIMIT = int(CONFIG.get("LIMIT", 5000))
+# Pending tasks of an active downstream service (e.g. match_details for match_history)
+# above which the upstream service pauses reserving new tasks
+BACKLOG_LIMIT = int(CONFIG.get("BACKLOG_LIMIT", 100000))
 # Worker Task reservation duration in minutes
 RESERVE_MINUTES = int(
     CONFIG.get("RESERVE_MINUTES", 2)
 )  # Task blocking duration in minutes
+# Identifies the reservations held by this instance
+# Defaults to the hostname with a random suffix so replicas on the same node differ
+OWNER_ID = CONFIG.get(
+    "OWNER_ID", "%s-%s" % (socket.gethostname(), uuid.uuid4().hex[:8])
+)[:63]
 
 #  ##### League Ranking Scraper
 # Minimum duration before the next cycle starts in hours
 LEAGUE_UPDATE = int(CONFIG.get("LEAGUE_UPDATE", 1))
 
 #  ##### Match History
-# Minimum time in hours after which a user will be queued to be updated again.
-AGE_THRESH = int(CONFIG.get("UPDATE_AGE", 48))  # TODO: Add support (See #22)
+# Minimum time in hours after which a user with fewer than MATCHES_THRESH new or an unknown
+# amount of matches will be queued to be updated again.
+AGE_THRESH = int(CONFIG.get("UPDATE_AGE", 48))
 # Minimum new matches (ranked only) after which a user will be queued to be updated again.
+# Users without new ranked matches are not updated.
 MATCHES_THRESH = int(CONFIG.get("MATCHES_THRESH", 10))
 # Queues to be filtered for in query and response
 QUEUES = CONFIG.get("QUEUES", "")
 
 #  ##### Match Timeline/Details
 BATCH_SIZE = int(CONFIG.get("BATCH_SIZE", 30))
+# Storage backend for match payloads: "files" (one JSON file per match)
+# or "archive" (zstd compressed segment files, requires the zstandard package)
+STORAGE = CONFIG.get("STORAGE", "files")
 # Details service settings
 # Backlog of details pulled
 # This should either be a timestamp/date or a relative delay value appropriated for postgres
+# Applies to match history requests and timeline selection, older pending details are archived
 MAX_AGE = CONFIG.get("MAX_AGE", "CURRENT_DATE - 45")
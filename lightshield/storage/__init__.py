@@ -0,0 +1,15 @@
+"""Storage backends for match payloads.
+
+Both backends take the same arguments: a tuple of path parts grouping the payload
+(e.g. patch, day and platform) and a unique name (the match id).
+"""
+from .archive import ArchiveReader, ArchiveStorage
+from .files import FileStorage
+from .writer import StorageWriter
+
+
+def get_storage(kind, root):
+    """Return the storage backend configured by name ("files" or "archive")."""
+    if kind == "archive":
+        return ArchiveStorage(root)
+    return FileStorage(root)
@@ -0,0 +1,162 @@
+import fcntl
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+class ArchiveStorage:
+    """Append matches as compressed frames to packed segment files.
+
+    Each combination of path parts is a segment made up of two files:
+    - [root]/[*parts].zst: Concatenated zstd frames, one per match.
+    - [root]/[*parts].idx: One line per match containing name, offset and length.
+    The data is written before the index, so an interrupted write at most leaves
+    unreferenced bytes at the end of a segment or an incomplete last index line,
+    which is ignored when loading the index.
+    Appends hold an exclusive flock on the data file, so multiple processes can share
+    the same root. Names stored by other processes are not known to this one, in which
+    case a match may be stored twice and the later entry is used when reading.
+    """
+
+    def __init__(self, root, level=3, max_open=16):
+        if not zstandard:
+            raise ImportError("The archive storage requires the zstandard package.")
+        self.root = root
+        self.level = level
+        self.max_open = max_open
+        self.local = threading.local()  # Compressors are not thread safe
+        self.lock = threading.Lock()
+        self.segments = OrderedDict()  # path: [data file, index file, names]
+
+    def open(self, parts):
+        """Return the open segment for the path parts, opening it if required."""
+        path = os.path.join(self.root, *parts)
+        if path in self.segments:
+            self.segments.move_to_end(path)
+            return self.segments[path]
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        names = set(ArchiveReader.load_index(path + ".idx"))
+        data = open(path + ".zst", "ab")
+        # Unbuffered, so each index line is appended with a single write
+        index = open(path + ".idx", "ab+", buffering=0)
+        self.segments[path] = segment = [data, index, names]
+        while len(self.segments) > self.max_open:
+            for file in self.segments.popitem(last=False)[1][:2]:
+                file.close()
+        return segment
+
+    def write(self, parts, name, raw):
+        """Append the raw body to its segment unless it is already stored.
+
+        Compression happens outside of the lock so multiple threads can write at once.
+        """
+        with self.lock:
+            if name in self.open(parts)[2]:
+                return
+        if not hasattr(self.local, "compressor"):
+            self.local.compressor = zstandard.ZstdCompressor(level=self.level)
+        frame = self.local.compressor.compress(raw)
+        with self.lock:
+            data, index, names = self.open(parts)
+            if name in names:
+                return
+            fcntl.flock(data, fcntl.LOCK_EX)
+            try:
+                # Other processes may have appended since, only the file size is reliable
+                offset = os.fstat(data.fileno()).st_size
+                data.write(frame)
+                data.flush()
+                line = b"%s %d %d\n" % (name.encode(), offset, len(frame))
+                # Terminate an incomplete line left by an interrupted write
+                size = os.fstat(index.fileno()).st_size
+                if size and os.pread(index.fileno(), 1, size - 1) != b"\n":
+                    line = b"\n" + line
+                index.write(line)
+            finally:
+                fcntl.flock(data, fcntl.LOCK_UN)
+            names.add(name)
+
+    def read(self, parts, name):
+        """Return the raw body of a stored match or None if it doesn't exist."""
+        with self.lock:
+            for file in self.segments.get(os.path.join(self.root, *parts), [])[:2]:
+                file.flush()
+        return ArchiveReader(self.root).read(parts, name)
+
+    def close(self):
+        """Close all open segment files."""
+        with self.lock:
+            for segment in self.segments.values():
+                for file in segment[:2]:
+                    file.close()
+            self.segments.clear()
+
+
+class ArchiveReader:
+    """Read matches from segments written by the ArchiveStorage."""
+
+    def __init__(self, root):
+        if not zstandard:
+            raise ImportError("The archive storage requires the zstandard package.")
+        self.root = root
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    @staticmethod
+    def load_index(filename):
+        """Return the index of a segment as {name: (offset, length)}.
+
+        Malformed lines and an unterminated last line, left by an interrupted write or
+        read while another process is appending, are skipped.
+        """
+        index = {}
+        try:
+            with open(filename, "r") as file:
+                for line in file:
+                    if not line.endswith("\n"):
+                        continue
+                    try:
+                        name, offset, length = line.split()
+                        index[name] = (int(offset), int(length))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return index
+
+    def segments(self):
+        """Yield the path parts of all segments in the archive."""
+        for folder, _, files in os.walk(self.root):
+            for filename in sorted(files):
+                if filename.endswith(".zst"):
+                    path = os.path.join(folder, filename[:-4])
+                    yield tuple(os.path.relpath(path, self.root).split(os.sep))
+
+    def index(self, parts):
+        """Return the index of the segment for the path parts."""
+        return self.load_index(os.path.join(self.root, *parts) + ".idx")
+
+    def read(self, parts, name):
+        """Return the raw body of a single match or None if it doesn't exist."""
+        path = os.path.join(self.root, *parts)
+        location = self.index(parts).get(name)
+        if not location:
+            return None
+        with open(path + ".zst", "rb") as file:
+            file.seek(location[0])
+            return self.decompressor.decompress(file.read(location[1]))
+
+    def iterate(self, parts):
+        """Yield (name, raw body) for all matches of a segment in stored order."""
+        path = os.path.join(self.root, *parts)
+        entries = sorted(self.index(parts).items(), key=lambda entry: entry[1][0])
+        with open(path + ".zst", "rb") as file:
+            for name, (offset, length) in entries:
+                file.seek(offset)
+                yield name, self.decompressor.decompress(file.read(length))
@@ -0,0 +1,36 @@
+import os
+
+
+class FileStorage:
+    """Store each match as a separate JSON file.
+
+    Files are saved as [root]/[*parts]/[name].json.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.folders = set()  # Folders known to exist
+
+    def write(self, parts, name, raw):
+        """Write the raw body unless the file already exists."""
+        path = os.path.join(self.root, *parts)
+        if path not in self.folders:
+            os.makedirs(path, exist_ok=True)
+            self.folders.add(path)
+        try:
+            with open(os.path.join(path, "%s.json" % name), "xb") as file:
+                file.write(raw)
+        except FileExistsError:
+            pass
+
+    def read(self, parts, name):
+        """Return the raw body of a stored match or None if it doesn't exist."""
+        filename = os.path.join(self.root, *parts, "%s.json" % name)
+        try:
+            with open(filename, "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        pass
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+class StorageWriter:
+    """Write payloads to a storage backend off the event loop.
+
+    Writes run in a thread pool with a bounded backlog; callers only wait while the
+    backlog is full. The optional done callback is called on the event loop once the
+    payload was stored, the optional failed callback once writing it failed.
+    """
+
+    def __init__(self, storage, backlog=200, threads=4):
+        self.storage = storage
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.slots = asyncio.Semaphore(backlog)
+        self.pending = set()
+        self.logging = logging.getLogger("Storage")
+
+    async def put(self, parts, name, raw, done=None, failed=None):
+        """Queue a payload to be written."""
+        await self.slots.acquire()
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, self.storage.write, parts, name, raw
+        )
+        self.pending.add(future)
+        future.add_done_callback(partial(self.finish, done, failed))
+
+    def finish(self, done, failed, future):
+        """Release the backlog slot and report the write."""
+        self.pending.discard(future)
+        self.slots.release()
+        if future.cancelled() or future.exception():
+            if not future.cancelled():
+                self.logging.error("Failed to write payload: %s", future.exception())
+            if failed:
+                failed()
+            return
+        if done:
+            done()
+
+    async def join(self):
+        """Wait for all queued writes to finish."""
+        if self.pending:
+            await asyncio.wait(list(self.pending))
+
+    async def close(self):
+        """Finish all queued writes and close the storage."""
+        await self.join()
+        self.executor.shutdown()
+        self.storage.close()
@@ -0,0 +1,64 @@
+\connect lightshield;
+-- Brings a database created by an earlier version up to the current startup scripts.
+-- The startup scripts only run on an empty database, existing ones have to run this file once:
+-- docker-compose -f compose-services.yaml exec -T postgres psql -U postgres < postgres/migrations/01_upgrade.sql
+-- All statements are idempotent so running it repeatedly is safe.
+DO
+$$
+    DECLARE
+        name TEXT;
+    BEGIN
+        FOREACH name IN ARRAY enum_range(NULL::platform)::TEXT[]
+            LOOP
+                EXECUTE format('ALTER TABLE %I.ranking ADD COLUMN IF NOT EXISTS reserved_by VARCHAR(63) DEFAULT NULL',
+                               lower(name));
+                EXECUTE format('CREATE INDEX IF NOT EXISTS ranking_last_updated_idx ON %I.ranking (last_updated)',
+                               lower(name));
+                EXECUTE format('CREATE INDEX IF NOT EXISTS ranking_reserved_by_idx ON %I.ranking (reserved_by) '
+                                   'WHERE reserved_by IS NOT NULL', lower(name));
+
+                -- Existing rows are stamped with the time of the upgrade
+                EXECUTE format('ALTER TABLE %I.participant ADD COLUMN IF NOT EXISTS '
+                                   'added TIMESTAMP DEFAULT CURRENT_TIMESTAMP', lower(name));
+                EXECUTE format('CREATE INDEX IF NOT EXISTS participant_added_idx ON %I.participant (added)',
+                               lower(name));
+            END LOOP;
+
+        FOREACH name IN ARRAY enum_range(NULL::region)::TEXT[]
+            LOOP
+                EXECUTE format('ALTER TABLE %I.match ADD COLUMN IF NOT EXISTS reserved_details_by VARCHAR(63)', name);
+                EXECUTE format('ALTER TABLE %I.match ADD COLUMN IF NOT EXISTS reserved_timeline_by VARCHAR(63)', name);
+                -- Replaced by the partial indexes below
+                EXECUTE format('DROP INDEX IF EXISTS %I.match_expr_find_fails_idx', name);
+                EXECUTE format('DROP INDEX IF EXISTS %I.match_expr_find_fails_idx1', name);
+                EXECUTE format('CREATE INDEX IF NOT EXISTS match_details_pending_idx ON %I.match '
+                                   '(find_fails, match_id DESC) WHERE details IS NULL AND find_fails <= 10', name);
+                EXECUTE format('CREATE INDEX IF NOT EXISTS match_timeline_pending_idx ON %I.match '
+                                   '(find_fails, match_id DESC) '
+                                   'WHERE timeline IS NULL AND details IS NOT NULL AND find_fails <= 10', name);
+                EXECUTE format('CREATE INDEX IF NOT EXISTS match_reserved_details_by_idx ON %I.match '
+                                   '(reserved_details_by) WHERE reserved_details_by IS NOT NULL', name);
+                EXECUTE format('CREATE INDEX IF NOT EXISTS match_reserved_timeline_by_idx ON %I.match '
+                                   '(reserved_timeline_by) WHERE reserved_timeline_by IS NOT NULL', name);
+                EXECUTE format('CREATE TABLE IF NOT EXISTS %I.match_archive (LIKE %I.match)', name, name);
+            END LOOP;
+    END
+$$;
+
+ALTER TABLE summoner
+    ADD COLUMN IF NOT EXISTS reserved_match_history_by VARCHAR(63) DEFAULT NULL,
+    ADD COLUMN IF NOT EXISTS games                     SMALLINT DEFAULT NULL,
+    ADD COLUMN IF NOT EXISTS games_at_update           SMALLINT DEFAULT NULL,
+    ADD COLUMN IF NOT EXISTS new_games                 SMALLINT GENERATED ALWAYS AS (games - games_at_update) STORED;
+CREATE INDEX IF NOT EXISTS summoner_reserved_match_history_by_idx ON summoner (reserved_match_history_by)
+    WHERE reserved_match_history_by IS NOT NULL;
+CREATE INDEX IF NOT EXISTS summoner_never_updated_idx ON summoner (last_platform) WHERE last_match IS NULL;
+CREATE INDEX IF NOT EXISTS summoner_last_platform_new_games_idx ON summoner (last_platform, new_games DESC);
+CREATE INDEX IF NOT EXISTS summoner_last_platform_last_updated_idx ON summoner (last_platform, last_updated);
+
+CREATE TABLE IF NOT EXISTS glue_watermark
+(
+    platform          platform PRIMARY KEY,
+    ranking_updated   TIMESTAMP DEFAULT NULL,
+    participant_added TIMESTAMP DEFAULT NULL
+);
@@ -21,6 +21,7 @@ CREATE TABLE IF NOT EXISTS PLATFORM.ranking
     priority       VARCHAR(1),
 
     reserved_until TIMESTAMP DEFAULT NULL,
+    reserved_by    VARCHAR(63) DEFAULT NULL,
     -- Update based on timestamp
     last_updated   TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
@@ -29,3 +30,7 @@ CREATE TABLE IF NOT EXISTS PLATFORM.ranking
 -- and match_history service (full refresh tasks)
 CREATE INDEX ON PLATFORM.ranking (puuid);
 CREATE INDEX ON PLATFORM.ranking ((puuid IS NULL));
+-- Incremental sync by the glue service
+CREATE INDEX ON PLATFORM.ranking (last_updated);
+-- Lease renewal by the reserving instance
+CREATE INDEX ON PLATFORM.ranking (reserved_by) WHERE reserved_by IS NOT NULL;
@@ -1,30 +1,44 @@
 \connect lightshield;
 CREATE TABLE IF NOT EXISTS REGION.match
 (
-    match_id          BIGINT,
-    platform          platform,
+    match_id             BIGINT,
+    platform             platform,
 
-    queue             SMALLINT,
-    timestamp         TIMESTAMP,
-    version           SMALLINT,
-    duration          SMALLINT DEFAULT NULL,
-    win               BOOLEAN  DEFAULT NULL,
+    queue                SMALLINT,
+    timestamp            TIMESTAMP,
+    version              SMALLINT,
+    duration             SMALLINT DEFAULT NULL,
+    win                  BOOLEAN  DEFAULT NULL,
 
     -- Needed to avoid excluding correct match_ids as faulty/deleted becaues they aren't found first try
     -- Retries up to 10 times
     -- On a failed try the reserved counter is not reset to avoid immediate retries on a presumed faulty ID
-    find_fails        SMALLINT DEFAULT 0,
-    reserved_details  TIMESTAMP,
-    reserved_timeline TIMESTAMP,
-    details           BOOLEAN,
-    timeline          BOOLEAN,
+    find_fails           SMALLINT DEFAULT 0,
+    reserved_details     TIMESTAMP,
+    reserved_timeline    TIMESTAMP,
+    -- Owner of the reservation, see settings.OWNER_ID
+    reserved_details_by  VARCHAR(63),
+    reserved_timeline_by VARCHAR(63),
+    details              BOOLEAN,
+    timeline             BOOLEAN,
     PRIMARY KEY (platform, match_id)
 );
 -- General lookups
 CREATE INDEX ON REGION.match ((timestamp::date), queue);
 -- Lookup for undone tasks
--- This will only  be used if most data in the table is not null,
--- so to use it data older than your minimum match_details age should be removed
--- see https://stackoverflow.com/questions/5203755/why-does-postgresql-perform-sequential-scan-on-indexed-column
-CREATE INDEX ON REGION.match ((details IS NULL), find_fails);
-CREATE INDEX ON REGION.match ((timeline IS NULL), find_fails);
+-- Partial indexes only contain pending rows and match the ordering of the task selection,
+-- so reserving a batch reads the first entries of the index instead of scanning the table.
+-- Rows drop out of the index once they are done or have failed too often.
+CREATE INDEX ON REGION.match (find_fails, match_id DESC)
+    WHERE details IS NULL AND find_fails <= 10;
+CREATE INDEX ON REGION.match (find_fails, match_id DESC)
+    WHERE timeline IS NULL AND details IS NOT NULL AND find_fails <= 10;
+-- Lease renewal by the reserving instance
+CREATE INDEX ON REGION.match (reserved_details_by) WHERE reserved_details_by IS NOT NULL;
+CREATE INDEX ON REGION.match (reserved_timeline_by) WHERE reserved_timeline_by IS NOT NULL;
+-- Matches still pending details once they fall out of the MAX_AGE window
+-- are moved here by the match_details service to keep the pending indexes small
+CREATE TABLE IF NOT EXISTS REGION.match_archive
+(
+    LIKE REGION.match
+);
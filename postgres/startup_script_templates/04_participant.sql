@@ -5,6 +5,9 @@ CREATE TABLE IF NOT EXISTS PLATFORM.participant
     puuid    VARCHAR(78),
     champ    SMALLINT,
     team     BOOLEAN,
+    -- Used by the glue service to only sync new entries
+    added    TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     PRIMARY KEY (match_id, puuid)
 );
 CREATE INDEX ON PLATFORM.participant(puuid);
+CREATE INDEX ON PLATFORM.participant(added);
@@ -1,12 +1,24 @@
 \connect lightshield;
 CREATE TABLE IF NOT EXISTS summoner
 (
-    puuid                  VARCHAR(78) PRIMARY KEY,
-    name                   VARCHAR(18),
+    puuid                     VARCHAR(78) PRIMARY KEY,
+    name                      VARCHAR(18),
 
-    reserved_match_history TIMESTAMP DEFAULT NULL,
-    last_updated           TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    last_platform          platform,
-    last_match             BIGINT
-);
+    reserved_match_history    TIMESTAMP DEFAULT NULL,
+    reserved_match_history_by VARCHAR(63) DEFAULT NULL,
+    last_updated              TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_platform             platform,
+    -- NULL until the first match history update, 0 if no match was found within MAX_AGE
+    last_match                BIGINT,
 
+    -- Ranked games played as last seen in the rankings and at the last match history update
+    games                     SMALLINT DEFAULT NULL,
+    games_at_update           SMALLINT DEFAULT NULL,
+    new_games                 SMALLINT GENERATED ALWAYS AS (games - games_at_update) STORED
+);
+-- Lease renewal by the reserving instance
+CREATE INDEX ON summoner (reserved_match_history_by) WHERE reserved_match_history_by IS NOT NULL;
+-- Match history task selection of never updated, active and outdated players
+CREATE INDEX ON summoner (last_platform) WHERE last_match IS NULL;
+CREATE INDEX ON summoner (last_platform, new_games DESC);
+CREATE INDEX ON summoner (last_platform, last_updated);
@@ -0,0 +1,9 @@
+\connect lightshield;
+-- Progress of the glue service per platform
+-- Only entries changed or added since the stored timestamps are synced into the summoner table
+CREATE TABLE IF NOT EXISTS glue_watermark
+(
+    platform          platform PRIMARY KEY,
+    ranking_updated   TIMESTAMP DEFAULT NULL,
+    participant_added TIMESTAMP DEFAULT NULL
+);
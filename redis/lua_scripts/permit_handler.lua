@@ -1,48 +1,78 @@
+-- Called before requests to reserve slots in all server and zone buckets
+-- Reserves up to the requested amount of slots at once and returns how many were granted,
+-- the wait time in ms for the remaining ones (0 if all were granted) as well as the state of
+-- each bucket so the caller does not have to look up limits separately and can mirror them locally
 
+-- KEYS: server key, zone key (in that order)
+-- Bucket state is returned per key as a flat list of: bucket_length, max, count, pttl
 
 local timestamp = ARGV[1]
+local requested = tonumber(ARGV[2] or 1)
 
 
+local buckets = {}
+for i=1, #KEYS do
+    buckets[i] = {}
+    local known = redis.call('hgetall', KEYS[i])
+    for n=1, #known, 2 do
+        if known[n] ~= 'placeholder' then
+            table.insert(buckets[i], {known[n], known[n + 1]})
+        end
+    end
+end
+
+local granted = requested
 local max_wait = 0
 -- Get permits
 for i=1, #KEYS do
     local key_type = KEYS[i]
-    for n, key in pairs(redis.call('hkeys', key_type)) do
-        if key ~= 'placeholder' then
-            local key_counter = key_type..':'..key
-            local key_meta = key_counter..':meta'
-            -- get max
-            local max_count = tonumber(redis.call('hget', key_meta, 'max'))
-            local rollover = tonumber(redis.call('hget', key_meta, 'rollover'))
-            -- get current
-            local current = 0
-            if redis.call('setnx', key_counter, 0) == 0 then
-                current = tonumber(redis.call('get', key_counter))
-            end
-            if (current + rollover) >= max_count then
-                -- Increase wait time if full
-                max_wait = math.max(100, max_wait, redis.call('pttl', key_counter))
-            end
+    for n, bucket in ipairs(buckets[i]) do
+        local key_counter = key_type..':'..bucket[1]
+        local key_meta = key_counter..':meta'
+        -- get max
+        local max_count = tonumber(redis.call('hget', key_meta, 'max'))
+        local rollover = tonumber(redis.call('hget', key_meta, 'rollover'))
+        -- get current
+        local current = 0
+        if redis.call('setnx', key_counter, 0) == 0 then
+            current = tonumber(redis.call('get', key_counter))
+        end
+        local pttl = redis.call('pttl', key_counter)
+        bucket[3] = current + rollover
+        bucket[4] = pttl
+        local available = max_count - (current + rollover)
+        if available < requested then
+            -- Increase wait time if the bucket cannot fit all requests
+            max_wait = math.max(100, max_wait, pttl)
         end
+        granted = math.max(0, math.min(granted, available))
     end
 end
 
-if max_wait > 0 then
-    return max_wait
-end
 -- Get reservations
-for i=1, #KEYS do
-    local key_type = KEYS[i]
-    for n, key in pairs(redis.call('hkeys', key_type)) do
-        if key ~= 'placeholder' then
-            local key_counter = key_type..':'..key
+if granted > 0 then
+    for i=1, #KEYS do
+        local key_type = KEYS[i]
+        for n, bucket in ipairs(buckets[i]) do
+            local key_counter = key_type..':'..bucket[1]
             local key_meta = key_counter..':meta'
             -- Increment
-            if redis.call('incr', key_counter) == 1 then
+            if redis.call('incrby', key_counter, granted) == granted then
                 redis.call('hset', key_meta, 'start_time', timestamp)
             end
-            redis.call('hincrby', key_meta, 'inflight', 1)
+            redis.call('hincrby', key_meta, 'inflight', granted)
+            bucket[3] = bucket[3] + granted
+        end
+    end
+end
+
+local state = {}
+for i=1, #KEYS do
+    state[i] = {}
+    for n, bucket in ipairs(buckets[i]) do
+        for m=1, 4 do
+            table.insert(state[i], bucket[m])
         end
     end
 end
-return 0
+return {max_wait, granted, state[1], state[2]}
@@ -1,7 +1,9 @@
 import asyncio
 import logging
 import os
+import socket
 
+import aioredis
 import asyncpg
 
 if "DEBUG" in os.environ:
@@ -29,43 +31,77 @@ services = [
 ]
 
 
+# Stream the services publish newly seen puuids to
+stream = "summoner_puuids"
+
+# Rows are synced again if they changed shortly before the watermark,
+# catching entries of transactions that committed after the last sync read the table
+overlap = "INTERVAL '5 minute'"
+
+
+async def get_watermark(con, platform, column):
+    """Return the timestamp up to which a platforms table was synced."""
+    return await con.fetchval(
+        "SELECT %s FROM glue_watermark WHERE platform = $1" % column, platform
+    )
+
+
+async def set_watermark(con, platform, column, value):
+    """Store the timestamp up to which a platforms table was synced."""
+    await con.execute(
+        """INSERT INTO glue_watermark (platform, %s)
+        VALUES ($1, $2)
+        ON CONFLICT (platform) DO UPDATE SET %s = EXCLUDED.%s
+        """
+        % (column, column, column),
+        platform,
+        value,
+    )
+
+
 async def sync_ranking():
     con = await asyncpg.connect(
         host="postgres", port=5432, user="postgres", database="lightshield"
     )
-    ranking_query = []
     for platform in services:
-        ranking_query.append(
+        watermark = await get_watermark(con, platform, "ranking_updated")
+        latest = await con.fetchval(
             """
-        SELECT DISTINCT puuid,
-                last_updated,
-                '%s'::varchar AS platform
-                FROM %s.ranking
+            WITH changed AS (
+                    SELECT DISTINCT ON (puuid) puuid,
+                           games_sq,
+                           last_updated
+                    FROM %s.ranking
+                    WHERE puuid IS NOT NULL
+                    AND ($1::timestamp IS NULL OR last_updated > $1::timestamp - %s)
+                    ORDER BY puuid, last_updated DESC
+                ),
+                inserted AS (
+                    INSERT INTO summoner (puuid, last_platform, games)
+                    SELECT puuid, $2::platform, games_sq
+                    FROM changed
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM summoner WHERE summoner.puuid = changed.puuid
+                    )
+                    ON CONFLICT DO NOTHING
+                ),
+                -- Ranked games played are used by the match_history service to prioritize active players
+                updated AS (
+                    UPDATE summoner
+                    SET games = changed.games_sq
+                    FROM changed
+                    WHERE summoner.puuid = changed.puuid
+                    AND changed.games_sq IS NOT NULL
+                    AND summoner.games IS DISTINCT FROM changed.games_sq
+                )
+            SELECT MAX(last_updated) FROM changed
         """
-            % (platform, platform)
+            % (platform, overlap),
+            watermark,
+            platform,
         )
-
-    await con.execute(
-        """
-        WITH preexisting AS (
-                SELECT DISTINCT puuid
-                FROM summoner
-            ),
-            rankings AS (
-                %s
-            ),
-            unique_players AS (
-                SELECT DISTINCT puuid,
-                       FIRST_VALUE(platform) OVER (PARTITION BY puuid ORDER BY last_updated DESC) AS platform
-                FROM rankings
-                WHERE puuid IS NOT NULL
-            )
-        INSERT INTO summoner (puuid, last_platform)
-        SELECT puuid, platform::platform FROM unique_players WHERE puuid NOT IN (SELECT puuid FROM preexisting)
-        ON CONFLICT DO NOTHING
-    """
-        % "UNION ALL".join(ranking_query)
-    )
+        if latest:
+            await set_watermark(con, platform, "ranking_updated", latest)
     logging.info("Synced ranking.")
     await con.close()
 
@@ -74,51 +110,119 @@ async def sync_participants():
     con = await asyncpg.connect(
         host="postgres", port=5432, user="postgres", database="lightshield"
     )
-    ranking_query = []
     for platform in services:
-        ranking_query.append(
+        watermark = await get_watermark(con, platform, "participant_added")
+        latest = await con.fetchval(
             """
-        SELECT puuid,
-                MAX(match_id) AS last_match,
-                '%s'::varchar AS platform
-                FROM %s.participant
-                GROUP BY puuid
+            WITH added AS (
+                    SELECT puuid,
+                           added
+                    FROM %s.participant
+                    WHERE $1::timestamp IS NULL OR added > $1::timestamp - %s
+                ),
+                inserted AS (
+                    INSERT INTO summoner (puuid, last_platform)
+                    SELECT DISTINCT puuid, $2::platform
+                    FROM added
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM summoner WHERE summoner.puuid = added.puuid
+                    )
+                    ON CONFLICT DO NOTHING
+                )
+            SELECT MAX(added) FROM added
         """
-            % (platform, platform)
+            % (platform, overlap),
+            watermark,
+            platform,
         )
-
-    await con.execute(
-        """
-        WITH preexisting AS (
-            SELECT DISTINCT puuid
-            FROM summoner
-            ),
-            participants AS (
-                %s
-            ),
-            last AS (
-                SELECT DISTINCT puuid,
-                        FIRST_VALUE(platform) OVER (PARTITION BY puuid ORDER BY last_match DESC) AS platform
-                FROM participants
-            )
-        INSERT INTO summoner (puuid, last_platform)
-                SELECT puuid, platform::platform FROM last WHERE puuid NOT IN (SELECT puuid FROM preexisting)             
-        ON CONFLICT DO NOTHING
-    """
-        % "UNION ALL".join(ranking_query)
-    )
+        if latest:
+            await set_watermark(con, platform, "participant_added", latest)
     await con.close()
     logging.info("Synced participants.")
 
 
-async def main():
+async def read_puuids(redis, con, consumer):
+    """Insert puuids from the stream into the summoner table until an error occurs."""
+    # Entries delivered but not acknowledged before a reconnect are read first
+    last_id = "0"
     while True:
-        await asyncio.gather(
-            asyncio.create_task(sync_participants()),
-            asyncio.create_task(sync_ranking()),
+        entries = await redis.xreadgroup(
+            "glue", consumer, {stream: last_id}, count=1000, block=5000
         )
+        messages = entries[0][1] if entries else []
+        if not messages:
+            last_id = ">"
+            continue
+        players = {}
+        for _, fields in messages:
+            players.setdefault(fields["puuid"], fields["platform"])
+        await con.execute(
+            """INSERT INTO summoner (puuid, last_platform)
+            SELECT * FROM unnest($1::varchar[], $2::platform[])
+            ON CONFLICT DO NOTHING
+            """,
+            list(players),
+            list(players.values()),
+        )
+        ids = [id for id, _ in messages]
+        await redis.xack(stream, "glue", *ids)
+        # glue is the only reader, processed entries are removed to bound the stream
+        await redis.xdel(stream, *ids)
+        logging.debug("Synced %s published puuids.", len(players))
+
+
+async def consume_puuids():
+    """Insert puuids published by the services into the summoner table as they arrive.
+
+    Connections are recreated after any error.
+    Redis runs without persistence, so a newly created group means entries published
+    before may have been lost. Participants are then synced from postgres before
+    consuming, as they are when the consumer first starts.
+    """
+    consumer = socket.gethostname()
+    caught_up = False
+    while True:
+        redis = con = None
+        try:
+            redis = aioredis.from_url(
+                "redis://redis:6379", encoding="utf-8", decode_responses=True
+            )
+            try:
+                await redis.xgroup_create(stream, "glue", id="0", mkstream=True)
+                caught_up = False
+            except aioredis.ResponseError:  # Group already exists
+                pass
+            if not caught_up:
+                await sync_participants()
+                caught_up = True
+            con = await asyncpg.connect(
+                host="postgres", port=5432, user="postgres", database="lightshield"
+            )
+            await read_puuids(redis, con, consumer)
+        except Exception as err:
+            logging.error("Puuid consumer failed, reconnecting: %s", err)
+        finally:
+            if con:
+                con.terminate()
+            if redis:
+                try:
+                    await redis.close()
+                except Exception as err:
+                    logging.error(err)
+        await asyncio.sleep(5)
+
+
+async def update_ranking():
+    while True:
+        await sync_ranking()
         await asyncio.sleep(60 * 60 * 1)
 
 
+async def main():
+    # Errors outside of the consumers own handling end the service instead of
+    # leaving it running without one of the tasks
+    await asyncio.gather(consume_puuids(), update_ranking())
+
+
 if __name__ == "__main__":
     asyncio.run(main())
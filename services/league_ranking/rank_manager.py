@@ -1,5 +1,6 @@
 """Manage which rank is to be crawled next."""
-from datetime import datetime, timedelta
+import heapq
+from datetime import datetime
 
 from lightshield import settings
 
@@ -18,42 +19,90 @@ tiers = [
 
 divisions = ["IV", "III", "II", "I"]
 
+# Refresh interval per tier as multiple of settings.LEAGUE_UPDATE
+# Small high tiers change quickly and are cheap to crawl, large low tiers are neither
+intervals = {
+    "IRON": 2,
+    "BRONZE": 2,
+    "SILVER": 1,
+    "GOLD": 1,
+    "PLATINUM": 1,
+    "EMERALD": 1,
+    "DIAMOND": 1,
+    "MASTER": 0.5,
+    "GRANDMASTER": 0.25,
+    "CHALLENGER": 0.25,
+}
+
 
 class RankManager:
-    """Ordering and Management of ranking updates."""
+    """Ordering and Management of ranking updates.
+
+    Ranks are kept in a heap ordered by the time they are due to be crawled again.
+    The last crawl and page count of each rank is persisted in a redis hash so a
+    restart continues the schedule instead of crawling every rank at once.
+    """
 
-    def __init__(self, logging):
+    def __init__(self, name, handler, logging):
         """Initiate logging."""
+        self.key = "league_ranking_%s" % name
+        self.handler = handler
         self.logging = logging
-        self.ranks = None
+        self.ranks = None  # Heap of [due timestamp, tier, division]
+        self.pages = {}  # (tier, division): page count of the last complete crawl
+        self.last = {}  # (tier, division): timestamp of the last complete crawl
 
     async def init(self):
-        """Open or create the ranking_cooldown tracking sheet."""
-        now = datetime.timestamp(
-            datetime.now() - timedelta(hours=settings.LEAGUE_UPDATE)
-        )
+        """Load the crawl state of all ranks."""
+        state = await self.handler.redis.hgetall(self.key)
         self.ranks = []
         for tier in tiers:
-            if tier in ["MASTER", "GRANDMASTER", "CHALLENGER"]:
-                self.ranks.append([tier, "I", now])
-                continue
             for division in divisions:
-                self.ranks.append([tier, division, now])
+                if tier in ["MASTER", "GRANDMASTER", "CHALLENGER"] and division != "I":
+                    continue
+                last, pages = 0, None
+                if entry := state.get("%s_%s" % (tier, division)):
+                    last, pages = entry.split(":")
+                    last = float(last)
+                    pages = int(pages) if pages else None
+                self.pages[(tier, division)] = pages
+                self.last[(tier, division)] = last
+                self.ranks.append([last + self.interval(tier), tier, division])
+        heapq.heapify(self.ranks)
+
+    @staticmethod
+    def interval(tier):
+        """Return the refresh interval of a tier in seconds."""
+        return intervals[tier] * settings.LEAGUE_UPDATE * 3600
+
+    async def get_delay(self):
+        """Return the seconds until the next rank is due."""
+        return self.ranks[0][0] - datetime.timestamp(datetime.now())
 
     async def get_next(self):
         """Return the next tier/division combination to be called."""
-        oldest_timestamp = None
-        oldest_key = None
-        for entry in self.ranks:
-            if not oldest_timestamp or entry[2] < oldest_timestamp:
-                oldest_key = entry[0:2]
-                oldest_timestamp = entry[2]
-        return oldest_key
-
-    async def update(self, key):
-        """Update the stats on a rank that is done pulling."""
+        _, tier, division = heapq.heappop(self.ranks)
+        return tier, division
+
+    async def get_pages(self, key):
+        """Return the page count of the last complete crawl of a rank or None."""
+        return self.pages[tuple(key)]
+
+    async def update(self, key, pages):
+        """Update the stats on a rank that was crawled completely."""
         now = datetime.timestamp(datetime.now())
-        for index, entry in enumerate(self.ranks):
-            if entry[0] == key[0] and entry[1] == key[1]:
-                self.ranks[index][2] = now
-                return
+        self.pages[tuple(key)] = pages
+        self.last[tuple(key)] = now
+        heapq.heappush(self.ranks, [now + self.interval(key[0]), *key])
+        await self.handler.redis.hset(
+            self.key, "%s_%s" % tuple(key), "%s:%s" % (now, pages)
+        )
+
+    async def requeue(self, key):
+        """Return a rank whose crawl was cut short with its previous due time.
+
+        The stored state is left untouched so the rank stays due after a restart.
+        """
+        heapq.heappush(
+            self.ranks, [self.last[tuple(key)] + self.interval(key[0]), *key]
+        )
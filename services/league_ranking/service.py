@@ -1,11 +1,7 @@
 import asyncio
 import logging
-from datetime import datetime, timedelta
-
-import aiohttp
 
 from lightshield.exceptions import (
-    LimitBlocked,
     RatelimitException,
     NotFoundException,
     Non200Exception,
@@ -17,17 +13,22 @@ class Service:
     running = False
     empty_page = False
     next_page = 1
+    last_page = None  # Expected last page based on the previous crawl
+    max_workers = 20
     daemon = None
     pages = None
     active_rank = None
+    chunk_size = 1000
 
     def __init__(self, name, handler):
         self.name = name
         self.logging = logging.getLogger("%s" % name)
         self.handler = handler
-        self.rankmanager = RankManager(self.logging)
-        self.retry_after = datetime.now()
-        self.data = []
+        self.rankmanager = RankManager(name, handler, self.logging)
+        self.data = []  # Entries not yet written
+        self.seen = set()  # Summoner ids found in the current division
+        self.updated = 0
+        self.flush_lock = None
         self.url = (
             f"https://{self.name}.api.riotgames.com/lol/"
             + "league-exp/v4/entries/RANKED_SOLO_5x5/%s/%s?page=%s"
@@ -35,6 +36,7 @@ class Service:
 
     async def init(self):
         self.pages = asyncio.Queue()
+        self.flush_lock = asyncio.Lock()
         await self.rankmanager.init()
         self.endpoint = await self.handler.proxy.get_endpoint(
             server=self.name, zone="league-v4-exp"
@@ -61,23 +63,30 @@ class Service:
                 await asyncio.sleep(5)
                 continue
             page = await self.pages.get()
-            if self.empty_page and page <= self.empty_page:
+            if self.empty_page and page >= self.empty_page:
                 return
             url = self.url % (*self.active_rank, page)
             try:
-                async with aiohttp.ClientSession(
-                    headers={"X-Riot-Token": self.handler.api_key}
-                ) as session:
-                    data = await self.endpoint.request(url, session)
-                    self.logging.debug(url)
-                    if not data:
-                        self.empty_page = max(self.empty_page or 0, page)
-                        return
-                    self.data += data
+                data = await self.endpoint.request(
+                    url, no_block=False, api_key=self.handler.api_key
+                )
+                self.logging.debug(url)
+                if not data:
+                    self.empty_page = min(self.empty_page or page, page)
+                    return
+                if not self.last_page or self.next_page < self.last_page:
                     self.next_page += 1
                     await self.pages.put(self.next_page)
-            except LimitBlocked as err:
-                self.retry_after = datetime.now() + timedelta(seconds=err.retry_after)
+                elif page >= self.next_page:
+                    # Beyond the expected end pages are probed one at a time
+                    self.next_page = page + 1
+                    await self.pages.put(self.next_page)
+                else:
+                    # All pages up to the expected end are scheduled
+                    await self.ingest(data)
+                    return
+                await self.ingest(data)
+                continue
             except RatelimitException:
                 pass
             except (Non200Exception, NotFoundException) as err:
@@ -85,8 +94,16 @@ class Service:
             except Exception as err:
                 await asyncio.sleep(1)
                 self.logging.exception("General Exception in Fetch")
-            finally:
-                await self.pages.put(page)
+            await self.pages.put(page)
+
+    async def ingest(self, data):
+        """Buffer a page and write the buffer once it reaches the chunk size."""
+        self.data += data
+        if len(self.data) < self.chunk_size:
+            return
+        chunk, self.data = self.data, []
+        async with self.flush_lock:
+            await self.update_data(chunk)
 
     async def runner(self):
         """Runner."""
@@ -94,13 +111,28 @@ class Service:
             if not self.running:
                 await asyncio.sleep(5)
                 continue
+            if (delay := await self.rankmanager.get_delay()) > 0:
+                await asyncio.sleep(min(delay, 5))
+                continue
             self.active_rank = await self.rankmanager.get_next()
-            workers = 20
+            self.last_page = await self.rankmanager.get_pages(self.active_rank)
+            # Limit parallel calls to the known remaining rate limit of the zone
+            # and the pages expected to exist. The server limit is shared with other
+            # services and doesn't reflect what is available to this one.
+            workers = self.max_workers
+            remaining = self.endpoint.remaining(self.endpoint.key_zone)
+            if remaining is not None:
+                workers = min(workers, remaining)
+            if self.last_page is not None:
+                workers = min(workers, self.last_page)
+            workers = max(1, workers)
             self.next_page = workers
             self.empty_page = False
             for i in range(1, workers + 1):
                 await self.pages.put(i)
             self.data = []
+            self.seen = set()
+            self.updated = 0
             try:
                 self.logging.debug("START %s %s.", *self.active_rank)
                 await asyncio.gather(
@@ -109,60 +141,147 @@ class Service:
                 self.logging.debug("DONE %s %s.", *self.active_rank)
             except asyncio.CancelledError:
                 return
-            await self.update_data()
-            self.logging.debug("INSERTED %s %s.", *self.active_rank)
+            async with self.flush_lock:
+                await self.update_data(self.data)
+                self.data = []
+                # Only a crawl that reached the last page knows who left the division
+                if self.empty_page and not self.handler.is_shutdown:
+                    await self.sweep()
+            self.logging.info(
+                "Updated %s users in %s %s.", self.updated, *self.active_rank
+            )
 
-            await self.rankmanager.update(key=self.active_rank)
+            # Only a complete crawl counts as an update of the division
+            if self.empty_page and not self.handler.is_shutdown:
+                await self.rankmanager.update(
+                    key=self.active_rank, pages=self.empty_page - 1
+                )
+            else:
+                await self.rankmanager.requeue(self.active_rank)
 
-    async def update_data(self):
-        "Update all changed users in the DB."
+    async def update_data(self, entries):
+        "Update all changed users of a chunk in the DB."
+        to_update = {}
+        for new in entries:
+            if new["summonerId"] in self.seen:
+                continue
+            self.seen.add(new["summonerId"])
+            to_update[new["summonerId"]] = (
+                new["summonerId"],
+                new["tier"],
+                new["rank"],
+                new["leaguePoints"],
+                new["wins"] + new["losses"],
+            )
+        if not to_update:
+            return
         async with self.handler.postgres.acquire() as connection:
             try:
                 latest = await connection.fetch(
                     """SELECT summoner_id,
                     rank,
                     division,
-                    leaguepoints
+                    leaguepoints,
+                    games_sq
                     FROM %s.ranking
-                    WHERE rank = $1
-                    AND division = $2
+                    WHERE summoner_id = ANY($1::varchar[])
                     """
                     % self.name.lower(),
-                    *self.active_rank,
+                    list(to_update),
                 )
-                preset = {}
-                if latest:
-                    for line in latest:
-                        preset[line["summoner_id"]] = [
-                            line["rank"],
-                            line["division"],
-                            line["leaguepoints"],
-                        ]
-                to_update = []
-                already_added = []
-                for new in self.data:
-                    rank = [new["tier"], new["rank"], new["leaguePoints"]]
-                    if (
-                        new["summonerId"] not in preset
-                        or preset[new["summonerId"]] != rank
+                for line in latest:
+                    if to_update[line["summoner_id"]][1:] == (
+                        line["rank"],
+                        line["division"],
+                        line["leaguepoints"],
+                        line["games_sq"],
                     ):
-                        if new["summonerId"] not in already_added:
-                            already_added.append(new["summonerId"])
-                            to_update.append([new["summonerId"]] + rank)
-                await connection.executemany(
-                    """INSERT INTO %s.ranking (summoner_id, rank, division, leaguepoints)
-                        VALUES ($1, $2, $3, $4)
-                        ON CONFLICT (summoner_id) DO 
-                        UPDATE SET rank = EXCLUDED.rank,
-                                   division = EXCLUDED.division,
-                                   leaguepoints = EXCLUDED.leaguepoints,
-                                   defunct = FALSE 
-                    """
-                    % self.name.lower(),
-                    to_update,
-                )
-                self.logging.info(
-                    "Updated %s users in %s %s.", len(to_update), *self.active_rank
+                        del to_update[line["summoner_id"]]
+                if not to_update:
+                    return
+                # Copy into a staging table and merge in a single statement
+                async with connection.transaction():
+                    await connection.execute(
+                        """CREATE TEMPORARY TABLE ranking_staging
+                            (
+                                summoner_id  VARCHAR(63),
+                                rank         rank,
+                                division     division,
+                                leaguepoints SMALLINT,
+                                games_sq     SMALLINT
+                            )
+                            ON COMMIT DROP
+                        """
+                    )
+                    await connection.copy_records_to_table(
+                        "ranking_staging", records=to_update.values()
+                    )
+                    await connection.execute(
+                        """INSERT INTO %s.ranking (summoner_id, rank, division, leaguepoints, games_sq)
+                            SELECT summoner_id, rank, division, leaguepoints, games_sq
+                            FROM ranking_staging
+                            ON CONFLICT (summoner_id) DO 
+                            UPDATE SET rank = EXCLUDED.rank,
+                                       division = EXCLUDED.division,
+                                       leaguepoints = EXCLUDED.leaguepoints,
+                                       games_sq = EXCLUDED.games_sq,
+                                       defunct = FALSE,
+                                       last_updated = current_timestamp
+                        """
+                        % self.name.lower(),
+                    )
+                    # Pass new games to known players so match_history can prioritize them
+                    await connection.execute(
+                        """UPDATE summoner
+                            SET games = ranking_staging.games_sq
+                            FROM ranking_staging
+                            JOIN %s.ranking USING (summoner_id)
+                            WHERE ranking.puuid = summoner.puuid
+                            AND summoner.games IS DISTINCT FROM ranking_staging.games_sq
+                        """
+                        % self.name.lower(),
+                    )
+                self.updated += len(to_update)
+            except Exception as err:
+                self.logging.error(err)
+
+    async def sweep(self):
+        """Remove the rank of players no longer found in the crawled division."""
+        async with self.handler.postgres.acquire() as connection:
+            try:
+                # Copy the seen ids into a staging table to remove the rest with an anti-join
+                async with connection.transaction():
+                    await connection.execute(
+                        """CREATE TEMPORARY TABLE seen_staging
+                            (summoner_id VARCHAR(63) PRIMARY KEY)
+                            ON COMMIT DROP
+                        """
+                    )
+                    await connection.copy_records_to_table(
+                        "seen_staging",
+                        records=[(summoner_id,) for summoner_id in self.seen],
+                    )
+                    result = await connection.execute(
+                        """UPDATE %s.ranking
+                            SET rank = NULL,
+                                division = NULL,
+                                leaguepoints = NULL,
+                                last_updated = current_timestamp
+                            WHERE rank = $1
+                            AND division = $2
+                            AND NOT EXISTS (
+                                SELECT 1
+                                FROM seen_staging
+                                WHERE seen_staging.summoner_id = ranking.summoner_id
+                            )
+                        """
+                        % self.name.lower(),
+                        *self.active_rank,
+                    )
+                self.logging.debug(
+                    "Removed %s users from %s %s.",
+                    result.split()[-1],
+                    *self.active_rank,
                 )
             except Exception as err:
                 self.logging.error(err)
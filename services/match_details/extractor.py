@@ -0,0 +1,64 @@
+"""Selective extraction of the match details fields used by the service.
+
+Instead of materializing the full response only the required fields are pulled
+from the raw body using an incremental parser. The result mirrors the layout of
+the `info` object of the response limited to those fields.
+"""
+import io
+
+try:
+    import ijson
+except ImportError:  # pragma: no cover
+    ijson = None
+
+from lightshield.proxy.payload import loads
+
+info_fields = {
+    "queueId",
+    "gameCreation",
+    "gameVersion",
+    "gameDuration",
+    "gameStartTimestamp",
+    "gameEndTimestamp",
+}
+team_fields = {"teamId", "win"}
+participant_fields = {"puuid", "championId", "teamId"}
+
+
+def extract(raw):
+    """Return the required fields of the match info from the raw response body."""
+    if not ijson:
+        return reduce(loads(raw)["info"])
+
+    info = {"teams": [], "participants": []}
+    for prefix, event, value in ijson.parse(io.BytesIO(raw), use_float=True):
+        if not prefix.startswith("info."):
+            continue
+        key = prefix[5:]
+        if key in info_fields:
+            info[key] = value
+        elif key == "teams.item":
+            if event == "start_map":
+                info["teams"].append({})
+        elif key.startswith("teams.item."):
+            if key[11:] in team_fields:
+                info["teams"][-1][key[11:]] = value
+        elif key == "participants.item":
+            if event == "start_map":
+                info["participants"].append({})
+        elif key.startswith("participants.item."):
+            if key[18:] in participant_fields:
+                info["participants"][-1][key[18:]] = value
+    return info
+
+
+def reduce(info):
+    """Limit an already decoded match info to the required fields."""
+    return {
+        **{key: value for key, value in info.items() if key in info_fields},
+        "teams": [{key: team[key] for key in team_fields} for team in info["teams"]],
+        "participants": [
+            {key: player[key] for key in participant_fields}
+            for player in info["participants"]
+        ],
+    }
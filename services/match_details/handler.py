@@ -74,6 +74,7 @@ class Handler:
                 for platform in self.platforms.values()
             ]
         )
+        await self.proxy.close()
         self.redis.close()
         await self.redis.wait_closed()
         await self.postgres.close()
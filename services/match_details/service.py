@@ -1,18 +1,20 @@
 import asyncio
-import json
 import logging
 import os
 from asyncio import Queue
-from datetime import datetime, timedelta
-
-import aiohttp
+from datetime import datetime
+from functools import partial
 
+from lightshield import settings
+from lightshield.leases import Leases
+from lightshield.players import publish
 from lightshield.exceptions import (
-    LimitBlocked,
     RatelimitException,
     NotFoundException,
     Non200Exception,
 )
+from lightshield.storage import StorageWriter, get_storage
+from extractor import extract
 
 
 class Platform:
@@ -30,11 +32,21 @@ class Platform:
         self.logging = logging.getLogger("%s" % region)
         self._worker = []  # Worker promises
         self.updater = None  # Updater promise
-        self.retry_after = datetime.now()
+        self.keeper = None  # Lease keeper promise
+        self.leases = Leases(
+            "%s.match" % region,
+            "reserved_details",
+            [("platform", "platform"), ("match_id", "bigint")],
+            self.logging,
+        )
+        self.backlog = None  # Backlog keeper promise
         self.proxy = handler.proxy
         self.endpoint_url = (
             f"https://{self.name}.api.riotgames.com/lol/match/v5/matches/%s_%s"
         )
+        self.writer = StorageWriter(
+            get_storage(settings.STORAGE, os.path.join(os.sep, "data", "details"))
+        )
 
     async def init(self):
         """Init background runner."""
@@ -46,7 +58,11 @@ class Platform:
     async def shutdown(self):
         self.logging.info("Shutdown")
         self.service_running = False
+        if self.keeper:
+            self.keeper.cancel()
+            self.backlog.cancel()
         await asyncio.gather(*self._worker, self.updater)
+        await self.writer.close()
         await self.flush_tasks()
 
     async def start(self):
@@ -58,6 +74,10 @@ class Platform:
                 server=self.name, zone="match-details-v5"
             )
             self.updater = asyncio.create_task(self.task_updater())
+            self.keeper = asyncio.create_task(
+                self.leases.keep(self.handler.postgres, lambda: self.service_running)
+            )
+            self.backlog = asyncio.create_task(self.backlog_keeper())
             self._worker = [
                 asyncio.create_task(self.worker()) for _ in range(self.worker_count)
             ]
@@ -67,6 +87,8 @@ class Platform:
         if self.service_running:
             self.service_running = False
             self.logging.info("Stopped service calls.")
+            self.keeper.cancel()
+            self.backlog.cancel()
             await self.updater
             for worker in self._worker:
                 worker.cancel()
@@ -74,6 +96,7 @@ class Platform:
                 await asyncio.gather(*self._worker)
             except asyncio.CancelledError:
                 pass
+            await self.writer.join()
             await self.flush_tasks()
 
     async def task_updater(self):
@@ -86,10 +109,15 @@ class Platform:
             if self.task_queue.qsize() > 200:
                 await asyncio.sleep(5)
                 continue
+            if await self.throttled():
+                self.logging.debug("Timeline backlog too large, sleeping")
+                await asyncio.sleep(5)
+                continue
             async with self.handler.postgres.acquire() as connection:
                 entries = await connection.fetch(
                     """UPDATE %s.match
-                            SET reserved_details = current_date + INTERVAL '10 minute'
+                            SET reserved_details = current_timestamp + $3 * INTERVAL '1 minute',
+                                reserved_details_by = $2
                             FROM (
                                 SELECT  match_id,
                                         platform
@@ -99,6 +127,7 @@ class Platform:
                                     AND (reserved_details IS NULL OR reserved_details < current_timestamp)
                                     ORDER BY find_fails, match_id DESC
                                     LIMIT $1
+                                    FOR UPDATE SKIP LOCKED
                                     ) selection
                         WHERE match.match_id = selection.match_id
                            AND match.platform = selection.platform
@@ -106,6 +135,8 @@ class Platform:
                     """
                     % tuple([self.name for _ in range(2)]),
                     1000,
+                    settings.OWNER_ID,
+                    settings.RESERVE_MINUTES,
                 )
                 self.logging.debug(
                     "Refilling tasks [%s -> %s].",
@@ -117,107 +148,195 @@ class Platform:
                     await self.flush_tasks()
                     pass
 
+                self.leases.hold(
+                    (entry["platform"], entry["match_id"]) for entry in entries
+                )
                 for entry in entries:
                     await self.task_queue.put([entry["platform"], entry["match_id"]])
 
+    async def throttled(self):
+        """Return whether the match_timeline service is active and too far behind."""
+        try:
+            active, backlog = await self.handler.redis.mget(
+                "service_match_timeline", "backlog_timeline_%s" % self.name
+            )
+        except Exception as err:
+            self.logging.error(err)
+            return False
+        return active == "true" and int(backlog or 0) > settings.BACKLOG_LIMIT
+
+    async def prune(self):
+        """Move pending matches older than settings.MAX_AGE to the archive table.
+
+        The age of matches pending details is unknown, instead matches with an id below
+        the newest match played the day before the window are moved.
+        Matches pending their timeline are moved by their timestamp, as the timeline
+        service no longer selects them.
+        """
+        async with self.handler.postgres.acquire() as connection:
+            while True:
+                moved = await connection.execute(
+                    """WITH boundary AS (
+                            SELECT platform,
+                                   MAX(match_id) AS match_id
+                                FROM %s.match
+                                WHERE timestamp::date = (%s)::date - 1
+                                GROUP BY platform
+                        ),
+                        moved AS (
+                            DELETE FROM %s.match
+                                WHERE (platform, match_id) IN (
+                                    SELECT match.platform, match.match_id
+                                        FROM %s.match
+                                        JOIN boundary USING (platform)
+                                        WHERE match.details IS NULL
+                                        AND match.find_fails <= 10
+                                        AND match.match_id < boundary.match_id
+                                        LIMIT $1
+                                )
+                                RETURNING *
+                        )
+                    INSERT INTO %s.match_archive
+                        SELECT * FROM moved
+                    """
+                    % (self.name, settings.MAX_AGE, self.name, self.name, self.name),
+                    10000,
+                )
+                count = int(moved.split()[-1])
+                if count:
+                    self.logging.info("Archived %s outdated matches.", count)
+                if count < 10000:
+                    break
+            while True:
+                moved = await connection.execute(
+                    """WITH moved AS (
+                            DELETE FROM %s.match
+                                WHERE (platform, match_id) IN (
+                                    SELECT platform, match_id
+                                        FROM %s.match
+                                        WHERE timeline IS NULL
+                                        AND details IS NOT NULL
+                                        AND find_fails <= 10
+                                        AND timestamp < (%s)::timestamp
+                                        LIMIT $1
+                                )
+                                RETURNING *
+                        )
+                    INSERT INTO %s.match_archive
+                        SELECT * FROM moved
+                    """
+                    % (self.name, self.name, settings.MAX_AGE, self.name),
+                    10000,
+                )
+                count = int(moved.split()[-1])
+                if count:
+                    self.logging.info("Archived %s outdated timelines.", count)
+                if count < 10000:
+                    return
+
+    async def backlog_keeper(self):
+        """Periodically set the backlog counter to the exact amount of pending matches.
+
+        Flushes keep the counter up to date in between, but can't account for matches
+        that are dropped after failing too often or moved to the archive.
+        """
+        while self.service_running:
+            try:
+                await self.prune()
+                async with self.handler.postgres.acquire() as connection:
+                    backlog = await connection.fetchval(
+                        """SELECT COUNT(*)
+                            FROM %s.match
+                            WHERE details IS NULL
+                            AND find_fails <= 10
+                        """
+                        % self.name,
+                    )
+                await self.handler.redis.set("backlog_details_%s" % self.name, backlog)
+            except Exception as err:
+                self.logging.error(err)
+            await asyncio.sleep(600)
+
     async def worker(self):
         """Execute requests."""
-        async with aiohttp.ClientSession(
-            headers={"X-Riot-Token": self.handler.api_key}
-        ) as session:
-            while self.service_running:
-                task = await self.task_queue.get()
-                try:
-                    #   Success
-                    url = self.endpoint_url % (task[0], task[1])
-                    response = await self.proxy_endpoint.request(url, session)
-                    if response["info"]["queueId"] == 0:
-                        raise NotFoundException  # TODO: queue 0 means its a custom, so it should be set to max retries immediatly
+        while self.service_running:
+            task = await self.task_queue.get()
+            try:
+                #   Success
+                url = self.endpoint_url % (task[0], task[1])
+                response = await self.proxy_endpoint.request(
+                    url, no_block=False, api_key=self.handler.api_key, raw=True
+                )
+                info = extract(response.raw)
+                if info["queueId"] == 0:
+                    raise NotFoundException  # TODO: queue 0 means its a custom, so it should be set to max retries immediatly
 
-                    # Extract relevant data
-                    queue = response["info"]["queueId"]
-                    creation = datetime.fromtimestamp(
-                        response["info"]["gameCreation"] // 1000
+                # Extract relevant data
+                queue = info["queueId"]
+                creation = datetime.fromtimestamp(info["gameCreation"] // 1000)
+                patch = ".".join(info["gameVersion"].split(".")[:2])
+                if "gameStartTimestamp" in info and "gameEndTimestamp" in info:
+                    game_duration = (
+                        info["gameEndTimestamp"] - info["gameStartTimestamp"]
                     )
-                    patch = ".".join(response["info"]["gameVersion"].split(".")[:2])
-                    if (
-                        "gameStartTimestamp" in response["info"]
-                        and "gameEndTimestamp" in response["info"]
-                    ):
-                        game_duration = (
-                            response["info"]["gameEndTimestamp"]
-                            - response["info"]["gameStartTimestamp"]
-                        )
-                    else:
-                        game_duration = response["info"]["gameDuration"]
-                    if game_duration >= 30000:
-                        game_duration //= 1000
-                    win = [
-                        team["win"]
-                        for team in response["info"]["teams"]
-                        if team["teamId"] == 100
-                    ][0]
-                    players = []
-                    for player in response["info"]["participants"]:
-                        players.append(
-                            [
-                                task[1],
-                                player["puuid"],
-                                player["championId"]
-                                if player["championId"] < 30000
-                                else -1,
-                                player["teamId"] != 100,
-                                # TODO: Add lane: 'lane': player['teamPosition'], (add as a enum in postgres first)
-                            ]
-                        )
-                    day = creation.strftime("%Y_%m_%d")
-                    patch_int = int("".join([el.zfill(2) for el in patch.split(".")]))
-                    path = os.path.join(os.sep, "data", "details", patch, day, task[0])
-                    if not os.path.exists(path):
-                        os.makedirs(path)
-                    filename = os.path.join(path, "%s_%s.json" % (task[0], task[1]))
-                    if not os.path.isfile(filename):
-                        with open(
-                            filename,
-                            "w+",
-                        ) as file:
-                            file.write(json.dumps(response))
-                    # del response
-                    package = {
-                        "match": [
-                            queue,
-                            creation,
-                            patch_int,
-                            game_duration,
-                            win,
-                            task[0],
+                else:
+                    game_duration = info["gameDuration"]
+                if game_duration >= 30000:
+                    game_duration //= 1000
+                win = [team["win"] for team in info["teams"] if team["teamId"] == 100][
+                    0
+                ]
+                players = []
+                for player in info["participants"]:
+                    players.append(
+                        [
                             task[1],
-                        ],
-                        "participant": players,
-                    }
-                    await self.match_updates.put(package)
-                    self.task_queue.task_done()
-                except LimitBlocked as err:
-                    self.retry_after = datetime.now() + timedelta(
-                        seconds=err.retry_after
+                            player["puuid"],
+                            player["championId"]
+                            if player["championId"] < 30000
+                            else -1,
+                            player["teamId"] != 100,
+                            # TODO: Add lane: 'lane': player['teamPosition'], (add as a enum in postgres first)
+                        ]
                     )
-                    await self.task_queue.put(task)
-                    self.task_queue.task_done()
-                except RatelimitException as err:
-                    self.logging.error("Ratelimit")
-                    await self.task_queue.put(task)
-                    self.task_queue.task_done()
-                except Non200Exception as err:
-                    self.logging.error("Others")
-                    await self.task_queue.put(task)
-                    self.task_queue.task_done()
-                except NotFoundException:
-                    await self.match_updates_faulty.put([task[0], task[1]])
-                    self.task_queue.task_done()
-                except Exception as err:
-                    self.logging.exception("General Exception")
-                    await self.task_queue.put(task)
-                    self.task_queue.task_done()
+                day = creation.strftime("%Y_%m_%d")
+                patch_int = int("".join([el.zfill(2) for el in patch.split(".")]))
+                package = {
+                    "match": [
+                        queue,
+                        creation,
+                        patch_int,
+                        game_duration,
+                        win,
+                        task[0],
+                        task[1],
+                    ],
+                    "participant": players,
+                }
+                await self.writer.put(
+                    (patch, day, task[0]),
+                    "%s_%s" % (task[0], task[1]),
+                    response.raw,
+                    done=partial(self.match_updates.put_nowait, package),
+                    failed=partial(self.task_queue.put_nowait, task),
+                )
+                del response
+                self.task_queue.task_done()
+            except RatelimitException as err:
+                self.logging.error("Ratelimit")
+                await self.task_queue.put(task)
+                self.task_queue.task_done()
+            except Non200Exception as err:
+                self.logging.error("Others")
+                await self.task_queue.put(task)
+                self.task_queue.task_done()
+            except NotFoundException:
+                await self.match_updates_faulty.put([task[0], task[1]])
+                self.task_queue.task_done()
+            except Exception as err:
+                self.logging.exception("General Exception")
+                await self.task_queue.put(task)
+                self.task_queue.task_done()
 
     async def flush_tasks(self):
         """Insert results from requests into the db."""
@@ -240,22 +359,41 @@ class Platform:
             async with connection.transaction():
                 if match_updates:
                     matches = [package["match"] for package in match_updates]
+                    queue, timestamp, version, duration, win, platform, match_id = [
+                        list(column) for column in zip(*matches)
+                    ]
                     # Insert match updates
-                    query = await connection.prepare(
+                    await connection.execute(
                         """UPDATE %s.match
-                        SET queue = $1,
-                            timestamp = $2,
-                            version = $3,
-                            duration = $4,
-                            win = $5,
+                        SET queue = updates.queue,
+                            timestamp = updates.timestamp,
+                            version = updates.version,
+                            duration = updates.duration,
+                            win = updates.win,
                             details = TRUE,
-                            reserved_details = NULL
-                            WHERE platform = $6
-                            AND match_id = $7
+                            reserved_details = NULL,
+                            reserved_details_by = NULL
+                            FROM unnest(
+                                $1::platform[], $2::bigint[], $3::smallint[],
+                                $4::timestamp[], $5::smallint[], $6::smallint[],
+                                $7::boolean[]
+                            ) AS updates (
+                                platform, match_id, queue,
+                                timestamp, version, duration,
+                                win
+                            )
+                            WHERE match.platform = updates.platform
+                            AND match.match_id = updates.match_id
                         """
                         % self.name,
+                        platform,
+                        match_id,
+                        queue,
+                        timestamp,
+                        version,
+                        duration,
+                        win,
                     )
-                    await query.executemany(matches)
 
                 platforms = {}
 
@@ -265,26 +403,64 @@ class Platform:
                     platforms[package["match"][-2]] += package["participant"]
 
                 for platform in platforms:
-                    await connection.executemany(
-                        """INSERT INTO %s.participant
-                            VALUES ($1, $2, $3, $4)
+                    # Copy into a staging table and merge in a single statement
+                    staging = "participant_%s" % platform.lower()
+                    await connection.execute(
+                        """CREATE TEMPORARY TABLE %s
+                            (LIKE %s.participant)
+                            ON COMMIT DROP
+                        """
+                        % (staging, platform),
+                    )
+                    await connection.copy_records_to_table(
+                        staging,
+                        records=platforms[platform],
+                        columns=["match_id", "puuid", "champ", "team"],
+                    )
+                    await connection.execute(
+                        """INSERT INTO %s.participant (match_id, puuid, champ, team)
+                            SELECT match_id, puuid, champ, team FROM %s
                             ON CONFLICT DO NOTHING
                         """
-                        % platform,
-                        platforms[platform],
+                        % (platform, staging),
                     )
 
                 if match_not_found:
                     await connection.execute(
                         """UPDATE %s.match
                             SET find_fails = find_fails + 1,
-                                reserved_details = current_date + INTERVAL '10 minute'
-                            WHERE platform::varchar || '_' || match_id::varchar = any($1::varchar[])
+                                reserved_details = current_timestamp + INTERVAL '10 minute',
+                                reserved_details_by = NULL
+                            FROM unnest($1::platform[], $2::bigint[])
+                                AS failed (platform, match_id)
+                            WHERE match.platform = failed.platform
+                            AND match.match_id = failed.match_id
                         """
                         % self.name,
-                        ["%s_%s" % match for match in match_not_found],
+                        [match[0] for match in match_not_found],
+                        [match[1] for match in match_not_found],
                     )
 
+        self.leases.release(tuple(package["match"][-2:]) for package in match_updates)
+        self.leases.release(tuple(match) for match in match_not_found)
+        if match_updates:
+            try:
+                async with self.handler.redis.pipeline(transaction=False) as pipe:
+                    # Matches move from the details to the timeline backlog
+                    pipe.decrby("backlog_details_%s" % self.name, len(match_updates))
+                    pipe.incrby("backlog_timeline_%s" % self.name, len(match_updates))
+                    await pipe.execute()
+            except Exception as err:
+                self.logging.error(err)
+            await publish(
+                self.handler.redis,
+                {
+                    (player[1], package["match"][-2])
+                    for package in match_updates
+                    for player in package["participant"]
+                },
+                self.logging,
+            )
         if match_updates or match_not_found:
             self.logging.info(
                 "Flushing %s match_updates (%s not found).",
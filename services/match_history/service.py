@@ -1,11 +1,9 @@
 import asyncio
 import logging
-from datetime import datetime, timedelta
-
-import aiohttp
 
+from lightshield import settings
+from lightshield.leases import Leases
 from lightshield.exceptions import (
-    LimitBlocked,
     RatelimitException,
     NotFoundException,
     Non200Exception,
@@ -26,18 +24,23 @@ class Platform:
         self.result_summoners = []  # Properly returning entries.
         self._worker = []  # Worker promises
         self.updater = None  # Updater promise
-        self.retry_after = datetime.now()
+        self.keeper = None  # Lease keeper promise
+        self.leases = Leases(
+            "summoner", "reserved_match_history", [("puuid", "varchar")], self.logging
+        )
         self.proxy = handler.proxy
         self.endpoint_url = (
             f"https://{self.name}.api.riotgames.com"
-            f"/lol/match/v5/matches/by-puuid/%s/ids?count=100&start=%s"
+            f"/lol/match/v5/matches/by-puuid/%s/ids?count=100&start=%s&startTime=%s"
         )
+        self.start_time = 0  # Epoch seconds of settings.MAX_AGE
 
     async def shutdown(self):
         self.logging.info("Shutdown")
         for worker in self._worker:
             worker.cancel()
         self.updater.cancel()
+        self.keeper.cancel()
         await self._runner
 
     async def start(self):
@@ -62,9 +65,12 @@ class Platform:
     async def runner(self):
         """Main object loop."""
         self.updater = asyncio.create_task(self.task_updater())
+        self.keeper = asyncio.create_task(
+            self.leases.keep(self.handler.postgres, lambda: self.running)
+        )
         self._worker = [asyncio.create_task(self.worker()) for _ in range(10)]
         try:
-            await asyncio.gather(*self._worker, self.updater)
+            await asyncio.gather(*self._worker, self.updater, self.keeper)
         except asyncio.CancelledError:
             await self.flush_tasks(
                 list(set(self.result_matchids)), self.result_summoners
@@ -86,23 +92,71 @@ class Platform:
             if len(self.tasks) > 50:
                 await asyncio.sleep(5)
                 continue
+            if await self.throttled():
+                self.logging.debug("Details backlog too large, sleeping")
+                await asyncio.sleep(5)
+                continue
             try:
                 async with self.handler.postgres.acquire() as connection:
+                    # Only request matches within the configured age
+                    self.start_time = await connection.fetchval(
+                        "SELECT EXTRACT(EPOCH FROM (%s)::timestamp)::BIGINT"
+                        % settings.MAX_AGE
+                    )
+                    # Never updated, active and outdated players are selected
+                    # separately so each selection is served by its own index
                     entries = await connection.fetch(
-                        """UPDATE summoner
-                                SET reserved_match_history = current_date + INTERVAL '10 minute'
-                                WHERE puuid IN (
+                        """WITH never AS (
+                                    SELECT puuid
+                                    FROM summoner
+                                    WHERE last_platform = any($1::platform[])
+                                    AND last_match IS NULL
+                                    AND (reserved_match_history IS NULL OR reserved_match_history < current_timestamp)
+                                    LIMIT $2
+                                    FOR UPDATE SKIP LOCKED
+                                ),
+                                active AS (
+                                    SELECT puuid
+                                    FROM summoner
+                                    WHERE last_platform = any($1::platform[])
+                                    AND new_games >= $5
+                                    AND (reserved_match_history IS NULL OR reserved_match_history < current_timestamp)
+                                    ORDER BY new_games DESC
+                                    LIMIT $2
+                                    FOR UPDATE SKIP LOCKED
+                                ),
+                                outdated AS (
                                     SELECT puuid
                                     FROM summoner
                                     WHERE last_platform = any($1::platform[])
-                                    ORDER BY CASE WHEN last_updated IS NULL THEN 0 ELSE 1 END, last_updated
+                                    AND last_updated < current_timestamp - $6 * INTERVAL '1 hour'
+                                    AND (new_games IS NULL OR new_games != 0)
+                                    AND (reserved_match_history IS NULL OR reserved_match_history < current_timestamp)
+                                    ORDER BY last_updated
+                                    LIMIT $2
+                                    FOR UPDATE SKIP LOCKED
+                                ),
+                                -- Later selections are only read if earlier ones don't fill the limit
+                                selection AS (
+                                    SELECT puuid FROM never
+                                    UNION ALL
+                                    SELECT puuid FROM active
+                                    UNION ALL
+                                    SELECT puuid FROM outdated
                                     LIMIT $2
-                                    FOR UPDATE
                                 )
+                            UPDATE summoner
+                                SET reserved_match_history = current_timestamp + $4 * INTERVAL '1 minute',
+                                    reserved_match_history_by = $3
+                                WHERE puuid IN (SELECT puuid FROM selection)
                                 RETURNING puuid, last_updated, last_match
                         """,
                         self.platforms,
                         200,
+                        settings.OWNER_ID,
+                        settings.RESERVE_MINUTES,
+                        settings.MATCHES_THRESH,
+                        settings.AGE_THRESH,
                     )
                     self.logging.debug(
                         "Refilling tasks [%s -> %s].",
@@ -118,23 +172,36 @@ class Platform:
                         await self.flush_tasks(matches, summoners)
 
                     self.tasks += entries
+                    self.leases.hold((entry["puuid"],) for entry in entries)
             except Exception as err:
                 self.logging.error(err)
 
-    async def fetch(self, target, start, session):
-        """Call and handle response."""
-        url = self.endpoint_url % (target, start)
+    async def throttled(self):
+        """Return whether the match_details service is active and too far behind."""
         try:
-            data = await self.endpoint.request(url, session)
+            active, backlog = await self.handler.redis.mget(
+                "service_match_details", "backlog_details_%s" % self.name
+            )
+        except Exception as err:
+            self.logging.error(err)
+            return False
+        return active == "true" and int(backlog or 0) > settings.BACKLOG_LIMIT
+
+    async def process(self, target, start, data):
+        """Handle the response or exception returned for a page."""
+        url = self.endpoint_url % (target, start, self.start_time)
+        try:
+            if isinstance(data, Exception):
+                raise data
             self.result_matchids += data
-            if start == 0:
+            if start == 0 and data:
                 platform, id = data[0].split("_")
                 id = int(id)
                 self.result_summoners.append([platform, id, target])
+            elif start == 0:
+                # No matches within MAX_AGE, marked as updated through last_match 0
+                self.result_summoners.append([None, 0, target])
             self.logging.debug(url)
-        except LimitBlocked as err:
-            self.retry_after = datetime.now() + timedelta(seconds=err.retry_after)
-            return start
         except RatelimitException as err:
             self.logging.error("Ratelimit")
             return start
@@ -143,6 +210,9 @@ class Platform:
             return start
         except NotFoundException:
             self.logging.error("Not found error.")
+            if start == 0:
+                # Marked as updated so the player is not retried immediately
+                self.result_summoners.append([None, 0, target])
         except Exception as err:
             self.logging.exception(err)
             return start
@@ -151,30 +221,27 @@ class Platform:
         """Update 10 pages for a user."""
         try:
             starts = [100 * i for i in range(10)]
-            async with aiohttp.ClientSession(
-                headers={"X-Riot-Token": self.handler.api_key}
-            ) as session:
-                while starts:
-                    while (
-                        delay := (self.retry_after - datetime.now()).total_seconds()
-                    ) > 0:
-                        await asyncio.sleep(min(0.1, delay))
-                    starts = [
-                        start
-                        for start in (
-                            await asyncio.gather(
-                                *[
-                                    asyncio.create_task(
-                                        self.fetch(target["puuid"], start, session)
-                                    )
-                                    for start in starts
-                                ]
-                            )
-                        )
-                        if start
+            while starts:
+                results = await self.endpoint.request_many(
+                    [
+                        self.endpoint_url % (target["puuid"], start, self.start_time)
+                        for start in starts
+                    ],
+                    no_block=False,
+                    api_key=self.handler.api_key,
+                )
+                starts = [
+                    start
+                    for start in [
+                        await self.process(target["puuid"], start, data)
+                        for start, data in zip(starts, results)
                     ]
+                    if start is not None
+                ]
         except Exception as err:
             self.logging.error("FULL: %s", err)
+            # Stop renewing so the player is picked up again once the lease runs out
+            self.leases.release([(target["puuid"],)])
 
     async def update_single(self, target):
         """Update a single page for a user."""
@@ -182,50 +249,46 @@ class Platform:
         new_last = None
         new_matches = []
         try:
-            async with aiohttp.ClientSession(
-                headers={"X-Riot-Token": self.handler.api_key}
-            ) as session:
-                while True:
-                    while (
-                        delay := (self.retry_after - datetime.now()).total_seconds()
-                    ) > 0:
-                        await asyncio.sleep(min(0.1, delay))
-                    url = self.endpoint_url % (target["puuid"], offset)
-                    try:
-                        data = await self.endpoint.request(url, session)
-                        if not new_last:
-                            new_last = data[0]
-                        if target["last_match"] in data:
-                            for entry in data:
-                                if entry == target["last_match"]:
-                                    break
-                                new_matches.append(entry)
-                            return new_matches
-                        else:
-                            new_matches += data
-                        if new_matches:
-                            self.result_matchids += new_matches
-                        if offset == 900:
-                            return new_matches
-                        offset += 100
-                    except LimitBlocked as err:
-                        self.retry_after = datetime.now() + timedelta(
-                            seconds=err.retry_after
-                        )
-                    except RatelimitException as err:
-                        self.logging.error("Ratelimit")
-                    except Non200Exception as err:
-                        self.logging.error("Others")
-                    except NotFoundException:
-                        self.logging.error("Not found error.")
-                    except Exception as err:
-                        self.logging.error(err)
+            while True:
+                url = self.endpoint_url % (target["puuid"], offset, self.start_time)
+                try:
+                    data = await self.endpoint.request(
+                        url, no_block=False, api_key=self.handler.api_key
+                    )
+                    if not data:
+                        return new_matches
+                    if not new_last:
+                        new_last = data[0]
+                    if target["last_match"] in data:
+                        for entry in data:
+                            if entry == target["last_match"]:
+                                break
+                            new_matches.append(entry)
+                        return new_matches
+                    else:
+                        new_matches += data
+                    if new_matches:
+                        self.result_matchids += new_matches
+                    if offset == 900:
+                        return new_matches
+                    offset += 100
+                except RatelimitException as err:
+                    self.logging.error("Ratelimit")
+                except Non200Exception as err:
+                    self.logging.error("Others")
+                except NotFoundException:
+                    self.logging.error("Not found error.")
+                except Exception as err:
+                    self.logging.error(err)
         except Exception as err:
             self.logging.error(err)
         finally:
-            platform, id = new_last.split("_")
-            id = int(id)
-            self.result_summoners.append([platform, id, target["puuid"]])
+            if new_last:
+                platform, id = new_last.split("_")
+                id = int(id)
+                self.result_summoners.append([platform, id, target["puuid"]])
+            else:
+                self.result_summoners.append([None, None, target["puuid"]])
 
     async def worker(self):
         """Execute requests."""
@@ -259,24 +322,42 @@ class Platform:
                     for match in list(set(matches)):
                         platform, id = match.split("_")
                         splits.append((platform, int(id)))
-                    query = await connection.prepare(
-                        """INSERT INTO %s.match (platform, match_id) VALUES ($1, $2)
-                            ON CONFLICT DO NOTHING
-                        """
-                        % self.name,
+                    # Copy into a staging table and merge in a single statement
+                    async with connection.transaction():
+                        await connection.execute(
+                            """CREATE TEMPORARY TABLE match_staging
+                                (platform platform, match_id BIGINT)
+                                ON COMMIT DROP
+                            """
+                        )
+                        await connection.copy_records_to_table(
+                            "match_staging", records=splits
+                        )
+                        inserted = await connection.execute(
+                            """INSERT INTO %s.match (platform, match_id)
+                                SELECT platform, match_id FROM match_staging
+                                ON CONFLICT DO NOTHING
+                            """
+                            % self.name,
+                        )
+                    # Matches pending details
+                    await self.handler.redis.incrby(
+                        "backlog_details_%s" % self.name, int(inserted.split()[-1])
                     )
-                    await query.executemany(splits)
                 if summoner:
                     summoner_cleaned = [[s[0], s[1], s[2]] for s in summoner]
                     query = await connection.prepare(
                         """UPDATE summoner
                             SET last_updated = current_timestamp,
-                                last_platform = $1,
-                                last_match = $2,
-                                reserved_match_history = NULL
+                                last_platform = COALESCE($1, last_platform),
+                                last_match = COALESCE($2, last_match),
+                                games_at_update = games,
+                                reserved_match_history = NULL,
+                                reserved_match_history_by = NULL
                             WHERE puuid = $3
                         """,
                     )
                     await query.executemany(summoner_cleaned)
+                    self.leases.release((s[2],) for s in summoner)
         except Exception as err:
             self.logging.info(err)
@@ -1,18 +1,19 @@
 import asyncio
-import json
 import logging
 import os
 from asyncio import Queue
-from datetime import datetime, timedelta
+from functools import partial
 
 import aiohttp
 
+from lightshield import settings
+from lightshield.leases import Leases
 from lightshield.exceptions import (
-    LimitBlocked,
     RatelimitException,
     NotFoundException,
     Non200Exception,
 )
+from lightshield.storage import StorageWriter, get_storage
 
 
 class Platform:
@@ -30,11 +31,21 @@ class Platform:
         self.logging = logging.getLogger("%s" % region)
         self._worker = []  # Worker promises
         self.updater = None  # Updater promise
-        self.retry_after = datetime.now()
+        self.keeper = None  # Lease keeper promise
+        self.leases = Leases(
+            "%s.match" % region,
+            "reserved_timeline",
+            [("platform", "platform"), ("match_id", "bigint")],
+            self.logging,
+        )
+        self.backlog = None  # Backlog keeper promise
         self.proxy = handler.proxy
         self.endpoint_url = (
             f"https://{self.name}.api.riotgames.com/lol/match/v5/matches/%s_%s/timeline"
         )
+        self.writer = StorageWriter(
+            get_storage(settings.STORAGE, os.path.join("data", "timeline"))
+        )
 
     async def init(self):
         """Init background runner."""
@@ -46,7 +57,11 @@ class Platform:
     async def shutdown(self):
         self.logging.info("Shutdown")
         self.service_running = False
+        if self.keeper:
+            self.keeper.cancel()
+            self.backlog.cancel()
         await asyncio.gather(*self._worker, self.updater)
+        await self.writer.close()
         await self.flush_tasks()
 
     async def start(self):
@@ -58,6 +73,10 @@ class Platform:
                 server=self.name, zone="match-timeline-v5"
             )
             self.updater = asyncio.create_task(self.task_updater())
+            self.keeper = asyncio.create_task(
+                self.leases.keep(self.handler.postgres, lambda: self.service_running)
+            )
+            self.backlog = asyncio.create_task(self.backlog_keeper())
             self._worker = [
                 asyncio.create_task(self.worker()) for _ in range(self.worker_count)
             ]
@@ -67,6 +86,8 @@ class Platform:
         if self.service_running:
             self.service_running = False
             self.logging.info("Stopped service calls.")
+            self.keeper.cancel()
+            self.backlog.cancel()
             await self.updater
             for worker in self._worker:
                 worker.cancel()
@@ -74,6 +95,7 @@ class Platform:
                 await asyncio.gather(*self._worker)
             except asyncio.CancelledError:
                 pass
+            await self.writer.join()
             await self.flush_tasks()
 
     async def task_updater(self):
@@ -89,7 +111,8 @@ class Platform:
             async with self.handler.postgres.acquire() as connection:
                 entries = await connection.fetch(
                     """UPDATE %s.match
-                            SET reserved_timeline = current_date + INTERVAL '10 minute'
+                            SET reserved_timeline = current_timestamp + $3 * INTERVAL '1 minute',
+                                reserved_timeline_by = $2
                             FROM (
                                 SELECT  match_id,
                                         platform
@@ -97,16 +120,20 @@ class Platform:
                                     WHERE timeline IS NULL
                                     AND details IS NOT NULL
                                     AND find_fails <= 10
+                                    AND timestamp >= (%s)::timestamp
                                     AND (reserved_timeline IS NULL OR reserved_timeline < current_timestamp)
                                     ORDER BY find_fails, match_id DESC
                                     LIMIT $1
+                                    FOR UPDATE SKIP LOCKED
                                     ) selection
                         WHERE match.match_id = selection.match_id
                            AND match.platform = selection.platform
                             RETURNING match.platform, match.match_id
                     """
-                    % tuple([self.name for _ in range(2)]),
+                    % (self.name, self.name, settings.MAX_AGE),
                     1000,
+                    settings.OWNER_ID,
+                    settings.RESERVE_MINUTES,
                 )
                 self.logging.debug(
                     "Refilling tasks [%s -> %s].",
@@ -118,59 +145,74 @@ class Platform:
                     await self.flush_tasks()
                     pass
 
+                self.leases.hold(
+                    (entry["platform"], entry["match_id"]) for entry in entries
+                )
                 for entry in entries:
                     await self.task_queue.put([entry["platform"], entry["match_id"]])
 
+    async def backlog_keeper(self):
+        """Periodically set the backlog counter to the exact amount of pending matches.
+
+        Flushes keep the counter up to date in between, but can't account for matches
+        that are dropped after failing too often or fall out of settings.MAX_AGE.
+        """
+        while self.service_running:
+            try:
+                async with self.handler.postgres.acquire() as connection:
+                    backlog = await connection.fetchval(
+                        """SELECT COUNT(*)
+                            FROM %s.match
+                            WHERE timeline IS NULL
+                            AND details IS NOT NULL
+                            AND find_fails <= 10
+                            AND timestamp >= (%s)::timestamp
+                        """
+                        % (self.name, settings.MAX_AGE),
+                    )
+                await self.handler.redis.set("backlog_timeline_%s" % self.name, backlog)
+            except Exception as err:
+                self.logging.error(err)
+            await asyncio.sleep(600)
+
     async def worker(self):
         """Execute requests."""
         while self.service_running:
-            for i in range(10):
-                async with aiohttp.ClientSession(
-                    headers={"X-Riot-Token": self.handler.api_key}
-                ) as session:
-                    task = await self.task_queue.get()
-                    try:
-                        url = self.endpoint_url % (task[0], task[1])
-                        response = await self.proxy_endpoint.request(url, session)
-                        folder = str(task[1])[:5]
-                        path = os.path.join("data", "timeline", task[0], folder)
-                        if not os.path.exists(path):
-                            os.makedirs(path)
-                        filename = os.path.join(path, "%s_%s.json" % (task[0], task[1]))
-                        if not os.path.isfile(filename):
-                            with open(
-                                filename,
-                                "w+",
-                            ) as file:
-                                file.write(json.dumps(response))
-                        del response
-                        await self.match_updates.put([task[0], task[1]])
-                        self.task_queue.task_done()
-                    except LimitBlocked as err:
-                        self.retry_after = datetime.now() + timedelta(
-                            seconds=err.retry_after
-                        )
-                        await self.task_queue.put(task)
-                        self.task_queue.task_done()
-                    except aiohttp.ServerDisconnectedError:
-                        self.logging.error("Server Disconnected")
-                        await self.task_queue.put(task)
-                        self.task_queue.task_done()
-                    except RatelimitException:
-                        self.logging.error("Ratelimit")
-                        await self.task_queue.put(task)
-                        self.task_queue.task_done()
-                    except Non200Exception:
-                        self.logging.error("Others")
-                        await self.task_queue.put(task)
-                        self.task_queue.task_done()
-                    except NotFoundException:
-                        await self.match_updates_faulty.put([task[0], task[1]])
-                        self.task_queue.task_done()
-                    except Exception:
-                        self.logging.exception("General Exception")
-                        await self.task_queue.put(task)
-                        self.task_queue.task_done()
+            task = await self.task_queue.get()
+            try:
+                url = self.endpoint_url % (task[0], task[1])
+                response = await self.proxy_endpoint.request(
+                    url, no_block=False, api_key=self.handler.api_key, raw=True
+                )
+                folder = str(task[1])[:5]
+                await self.writer.put(
+                    (task[0], folder),
+                    "%s_%s" % (task[0], task[1]),
+                    response.raw,
+                    done=partial(self.match_updates.put_nowait, [task[0], task[1]]),
+                    failed=partial(self.task_queue.put_nowait, task),
+                )
+                del response
+                self.task_queue.task_done()
+            except aiohttp.ServerDisconnectedError:
+                self.logging.error("Server Disconnected")
+                await self.task_queue.put(task)
+                self.task_queue.task_done()
+            except RatelimitException:
+                self.logging.error("Ratelimit")
+                await self.task_queue.put(task)
+                self.task_queue.task_done()
+            except Non200Exception:
+                self.logging.error("Others")
+                await self.task_queue.put(task)
+                self.task_queue.task_done()
+            except NotFoundException:
+                await self.match_updates_faulty.put([task[0], task[1]])
+                self.task_queue.task_done()
+            except Exception:
+                self.logging.exception("General Exception")
+                await self.task_queue.put(task)
+                self.task_queue.task_done()
 
     async def flush_tasks(self):
         """Insert results from requests into the db."""
@@ -192,27 +234,45 @@ class Platform:
             async with connection.transaction():
                 if match_updates:
                     # Insert match updates
-                    query = await connection.prepare(
+                    await connection.execute(
                         """UPDATE %s.match
                         SET timeline = TRUE,
-                            reserved_timeline = NULL
-                            WHERE platform = $1
-                            AND match_id = $2
+                            reserved_timeline = NULL,
+                            reserved_timeline_by = NULL
+                            FROM unnest($1::platform[], $2::bigint[])
+                                AS updates (platform, match_id)
+                            WHERE match.platform = updates.platform
+                            AND match.match_id = updates.match_id
                         """
                         % self.name,
+                        [match[0] for match in match_updates],
+                        [match[1] for match in match_updates],
                     )
-                    await query.executemany(match_updates)
 
                 if match_not_found:
                     await connection.execute(
                         """UPDATE %s.match
                             SET find_fails = find_fails + 1,
-                                reserved_timeline = current_date + INTERVAL '10 minute'
-                            WHERE platform::varchar || '_' || match_id::varchar = any($1::varchar[])
+                                reserved_timeline = current_timestamp + INTERVAL '10 minute',
+                                reserved_timeline_by = NULL
+                            FROM unnest($1::platform[], $2::bigint[])
+                                AS failed (platform, match_id)
+                            WHERE match.platform = failed.platform
+                            AND match.match_id = failed.match_id
                         """
                         % self.name,
-                        ["%s_%s" % match for match in match_not_found],
+                        [match[0] for match in match_not_found],
+                        [match[1] for match in match_not_found],
                     )
+        self.leases.release(tuple(match) for match in match_updates)
+        self.leases.release(tuple(match) for match in match_not_found)
+        if match_updates:
+            try:
+                await self.handler.redis.decrby(
+                    "backlog_timeline_%s" % self.name, len(match_updates)
+                )
+            except Exception as err:
+                self.logging.error(err)
         if match_updates or match_not_found:
             self.logging.info(
                 "Flushing %s match_updates (%s not found).",
@@ -1,11 +1,10 @@
 import asyncio
 import logging
-from datetime import datetime, timedelta
-
-import aiohttp
 
+from lightshield import settings
+from lightshield.leases import Leases
+from lightshield.players import publish
 from lightshield.exceptions import (
-    LimitBlocked,
     RatelimitException,
     NotFoundException,
     Non200Exception,
@@ -25,7 +24,14 @@ class Platform:
         self.not_found = []  # Empty returning summoner-v4
         self._worker = []  # Worker promises
         self.updater = None  # Updater promise
-        self.retry_after = datetime.now()
+        self.keeper = None  # Lease keeper promise
+        self.leases = Leases(
+            "%s.ranking" % name.lower(),
+            "reserved_until",
+            [("summoner_id", "varchar")],
+            self.logging,
+            owner="reserved_by",
+        )
         self.proxy = handler.proxy
         self.endpoint_url = (
             f"https://{name}.api.riotgames.com/lol/summoner/v4/summoners/%s"
@@ -36,6 +42,7 @@ class Platform:
         for worker in self._worker:
             worker.cancel()
         self.updater.cancel()
+        self.keeper.cancel()
         await self._runner
 
     async def start(self):
@@ -60,9 +67,12 @@ class Platform:
     async def runner(self):
         """Main object loop."""
         self.updater = asyncio.create_task(self.task_updater())
+        self.keeper = asyncio.create_task(
+            self.leases.keep(self.handler.postgres, lambda: self.running)
+        )
         self._worker = [asyncio.create_task(self.worker()) for _ in range(10)]
         try:
-            await asyncio.gather(*self._worker, self.updater)
+            await asyncio.gather(*self._worker, self.updater, self.keeper)
         except asyncio.CancelledError:
             await self.flush_tasks(self.results, self.not_found)
             return
@@ -88,7 +98,8 @@ class Platform:
             async with self.handler.postgres.acquire() as connection:
                 entries = await connection.fetch(
                     """UPDATE %s.ranking
-                            SET reserved_until = CURRENT_DATE + INTERVAL '10 minute'
+                            SET reserved_until = CURRENT_TIMESTAMP + $3 * INTERVAL '1 minute',
+                                reserved_by = $2
                             WHERE summoner_id IN (
                                 SELECT summoner_id
                                 FROM %s.ranking
@@ -96,12 +107,14 @@ class Platform:
                                     AND puuid IS NULL
                                     AND (reserved_until < CURRENT_TIMESTAMP OR reserved_until IS NULL)
                                     LIMIT $1
-                                    FOR UPDATE
+                                    FOR UPDATE SKIP LOCKED
                             )
                             RETURNING summoner_id
                     """
                     % (self.name.lower(), self.name.lower()),
                     500,
+                    settings.OWNER_ID,
+                    settings.RESERVE_MINUTES,
                 )
                 self.logging.debug(
                     "Refilling tasks [%s -> %s].",
@@ -116,17 +129,15 @@ class Platform:
                     self.not_found = []
                     await self.flush_tasks(results, not_found)
                 self.tasks += [entry["summoner_id"] for entry in entries]
+                self.leases.hold((entry["summoner_id"],) for entry in entries)
 
-    async def fetch(self, target, session):
-        """Call and handle response."""
-        url = self.endpoint_url % target
+    async def process(self, target, data):
+        """Handle the response or exception returned for a target."""
         try:
-            data = await self.endpoint.request(url, session)
+            if isinstance(data, Exception):
+                raise data
             self.results.append([data["puuid"], data["id"]])
             # self.logging.debug(url)
-        except LimitBlocked as err:
-            self.retry_after = datetime.now() + timedelta(seconds=err.retry_after)
-            return target
         except RatelimitException as err:
             self.logging.error("Ratelimit")
             return target
@@ -146,8 +157,6 @@ class Platform:
             await asyncio.sleep(5)
         while True:
             await asyncio.sleep(0.1)
-            while (delay := (self.retry_after - datetime.now()).total_seconds()) > 0:
-                await asyncio.sleep(min(0.1, delay))
             if not self.running:
                 await asyncio.sleep(5)
                 continue
@@ -159,21 +168,19 @@ class Platform:
                     break
                 targets.append(self.tasks.pop())
 
-            async with aiohttp.ClientSession(
-                headers={"X-Riot-Token": self.handler.api_key}
-            ) as session:
-                targets = [
-                    target
-                    for target in (
-                        await asyncio.gather(
-                            *[
-                                asyncio.create_task(self.fetch(target, session))
-                                for target in targets
-                            ]
-                        )
-                    )
-                    if target
+            results = await self.endpoint.request_many(
+                [self.endpoint_url % target for target in targets],
+                no_block=False,
+                api_key=self.handler.api_key,
+            )
+            targets = [
+                target
+                for target in [
+                    await self.process(target, data)
+                    for target, data in zip(targets, results)
                 ]
+                if target
+            ]
 
     async def flush_tasks(self, results, not_found):
         """Insert results from requests into the db."""
@@ -188,7 +195,9 @@ class Platform:
                 prep = await connection.prepare(
                     """UPDATE %s.ranking
                         SET puuid = $1,
-                            reserved_until = NULL
+                            last_updated = current_timestamp,
+                            reserved_until = NULL,
+                            reserved_by = NULL
                         WHERE summoner_id =  $2
                     """
                     % self.name
@@ -197,9 +206,18 @@ class Platform:
             if not_found:
                 await connection.execute(
                     """UPDATE %s.ranking
-                        SET defunct=TRUE
-                        WHERE summoner_id = ANY($1::varchar)
+                        SET defunct=TRUE,
+                            reserved_by = NULL
+                        WHERE summoner_id = ANY($1::varchar[])
                     """
                     % self.name,
                     not_found,
                 )
+        self.leases.release((summoner_id,) for _, summoner_id in results)
+        self.leases.release((summoner_id,) for summoner_id in not_found)
+        if results:
+            await publish(
+                self.handler.redis,
+                [(puuid, self.name) for puuid, _ in results],
+                self.logging,
+            )
@@ -0,0 +1,39 @@
+import pytest
+
+zstandard = pytest.importorskip("zstandard")
+
+from lightshield.storage.archive import ArchiveReader, ArchiveStorage
+
+
+def test_write_and_read(tmp_path):
+    storage = ArchiveStorage(str(tmp_path))
+    storage.write(("12", "EUW1"), "EUW1_1", b"first")
+    storage.write(("12", "EUW1"), "EUW1_2", b"second")
+    storage.close()
+    reader = ArchiveReader(str(tmp_path))
+    assert reader.read(("12", "EUW1"), "EUW1_1") == b"first"
+    assert reader.read(("12", "EUW1"), "EUW1_2") == b"second"
+
+
+def test_interrupted_index_line_is_ignored(tmp_path):
+    storage = ArchiveStorage(str(tmp_path))
+    storage.write(("EUW1",), "EUW1_1", b"first")
+    storage.close()
+    with open(tmp_path / "EUW1.idx", "a") as index:
+        index.write("EUW1_2 12")
+    assert list(ArchiveReader.load_index(str(tmp_path / "EUW1.idx"))) == ["EUW1_1"]
+
+    storage = ArchiveStorage(str(tmp_path))
+    storage.write(("EUW1",), "EUW1_3", b"third")
+    storage.close()
+    reader = ArchiveReader(str(tmp_path))
+    assert list(reader.index(("EUW1",))) == ["EUW1_1", "EUW1_3"]
+    assert reader.read(("EUW1",), "EUW1_3") == b"third"
+
+
+def test_malformed_index_line_is_skipped(tmp_path):
+    (tmp_path / "EUW1.idx").write_text("EUW1_1 0 5\ngarbage\nEUW1_2 x 3\nEUW1_3 5 4\n")
+    assert ArchiveReader.load_index(str(tmp_path / "EUW1.idx")) == {
+        "EUW1_1": (0, 5),
+        "EUW1_3": (5, 4),
+    }
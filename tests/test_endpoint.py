@@ -0,0 +1,59 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from lightshield.proxy.endpoint import Endpoint
+
+
+class Sync:
+    """Collect the updates passed on by the endpoint."""
+
+    def __init__(self):
+        self.added = []
+
+    async def add(self, *args):
+        self.added.append(args)
+
+
+def make_endpoint():
+    return Endpoint("EUW1", "league-v4", None, "", Sync(), None)
+
+
+def test_mirror_tracks_active_buckets():
+    endpoint = make_endpoint()
+    limits = endpoint.mirror(
+        endpoint.key_zone, ["10", "20", "5", "800", "600", "100", "12", "-1"]
+    )
+    assert limits == {"10": "20", "600": "100"}
+    assert list(endpoint.buckets) == ["%s:10" % endpoint.key_zone]
+    max_count, count, reset = endpoint.buckets["%s:10" % endpoint.key_zone]
+    assert (max_count, count) == (20, 5)
+    assert datetime.now() < reset <= datetime.now() + timedelta(milliseconds=800)
+
+
+def test_response_raises_mirrored_counts():
+    endpoint = make_endpoint()
+    key = endpoint.key_zone
+    endpoint.mirror(key, ["10", "20", "5", "800"])
+    asyncio.run(
+        endpoint.response({"10": "20"}, key, "20:10,100:600", "9:10,1:600", 1, 2)
+    )
+    assert endpoint.buckets["%s:10" % key][1] == 9
+    assert endpoint.sync.added == [(key, [100, 600], [], [], [[10, 9], [600, 1]], 1, 2)]
+
+
+def test_response_keeps_higher_local_count():
+    endpoint = make_endpoint()
+    key = endpoint.key_zone
+    endpoint.mirror(key, ["10", "20", "15", "800"])
+    asyncio.run(endpoint.response({"10": "20"}, key, "25:10", "3:10", 1, 2))
+    assert endpoint.buckets["%s:10" % key][1] == 15
+    assert endpoint.sync.added == [(key, [], [25, 10], [], [[10, 3]], 1, 2)]
+
+
+def test_remaining_limited_to_key():
+    endpoint = make_endpoint()
+    endpoint.mirror(endpoint.key_server, ["10", "100", "95", "800"])
+    endpoint.mirror(endpoint.key_zone, ["10", "20", "5", "800"])
+    assert endpoint.remaining() == 5
+    assert endpoint.remaining(endpoint.key_zone) == 15
+    assert endpoint.remaining(endpoint.key_server) == 5
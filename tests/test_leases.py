@@ -0,0 +1,58 @@
+import asyncio
+import logging
+
+from lightshield import settings
+from lightshield.leases import Leases
+
+
+class Connection:
+    """Collect the executed statements."""
+
+    def __init__(self):
+        self.executed = []
+
+    async def execute(self, query, *args):
+        self.executed.append((query, args))
+
+
+def make_leases():
+    return Leases(
+        "europe.match",
+        "reserved_details",
+        [("platform", "platform"), ("match_id", "bigint")],
+        logging.getLogger("test"),
+    )
+
+
+def test_renew_only_held_tasks():
+    leases = make_leases()
+    leases.hold([("EUW1", 1), ("EUW1", 2)])
+    leases.release([("EUW1", 1)])
+    connection = Connection()
+    asyncio.run(leases.renew(connection))
+    ((query, args),) = connection.executed
+    assert "unnest($3::platform[], $4::bigint[]) AS held (platform, match_id)" in query
+    assert "target.reserved_details_by = $1" in query
+    assert args == (settings.OWNER_ID, settings.RESERVE_MINUTES, ["EUW1"], [2])
+
+
+def test_renew_skips_without_held_tasks():
+    connection = Connection()
+    asyncio.run(make_leases().renew(connection))
+    assert connection.executed == []
+
+
+def test_sweep_uses_owner_column():
+    leases = Leases(
+        "euw1.ranking",
+        "reserved_until",
+        [("summoner_id", "varchar")],
+        logging.getLogger("test"),
+        owner="reserved_by",
+    )
+    connection = Connection()
+    asyncio.run(leases.sweep(connection))
+    ((query, args),) = connection.executed
+    assert "reserved_by = NULL" in query
+    assert "WHERE reserved_by IS NOT NULL" in query
+    assert "reserved_until < current_timestamp" in query
@@ -0,0 +1,50 @@
+import asyncio
+import logging
+
+from lightshield.players import publish, stream
+
+
+class Pipeline:
+    """Collect the commands queued on a pipeline."""
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def xadd(self, *args, **kwargs):
+        self.redis.added.append((args, kwargs))
+
+    async def execute(self):
+        if self.redis.fail:
+            raise ConnectionError()
+
+
+class Redis:
+    def __init__(self, fail=False):
+        self.added = []
+        self.fail = fail
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self)
+
+
+def test_publish_adds_players_to_stream():
+    redis = Redis()
+    asyncio.run(publish(redis, [("puuid", "EUW1")], logging.getLogger("test")))
+    assert redis.added == [
+        (
+            (stream, {"puuid": "puuid", "platform": "EUW1"}),
+            {"maxlen": 1000000, "approximate": True},
+        )
+    ]
+
+
+def test_publish_logs_failures():
+    asyncio.run(
+        publish(Redis(fail=True), [("puuid", "EUW1")], logging.getLogger("test"))
+    )